@@ -14,9 +14,21 @@ class AnomalyData:
     - n_layers: # layers in deep autoencoder model
     - replicate_for_training: If the dataset is too small, we will replicate the data before training the deep autoencodering
     - multiplier: by what rate should the new layer in the encoder model should decreasing than the previous layer
+    - store_path: the path of the memory-mapped dataset store (see data_store.py); used instead of the .npy files when it exists
+    - cache_path: the folder where preprocessed data is cached between runs
+    - dedup: if True, the models are fitted and scored on the unique rows weighted by their counts (for low-dimensional binary data)
+    - pca_solver: eigensolver of the PCA fit: 'full' computes all the components; 'eigsh' or 'randomized' compute only the top n_components
+    - chunk_size: if given, the PCA detectors fit and score the data this many rows at a time (for data larger than the memory, e.g. memory maps)
+    - pca_cache: if True, the PCA detectors share one fit (and the encoded data) of the same training data, see get_pca_fit()
+    - covariance_estimator: covariance of the Autoencoder Gaussian detector: 'cv' whitens it with the lambda chosen by cross validation; 'ledoit_wolf' or 'oas' shrink it in closed form (no labels, no folds)
+    - threshold_folds: if given, the Reconstruction Error detectors select their threshold with this many cross-validation folds
+    - cv_workers: number of processes of the cross validations (the whitening lambda search and threshold_folds)
+    - dtype: float type of the PCA, Gaussian and distance computations (e.g. np.float32); None uses compute_dtype in support_functions.py
+    - save_pca_model: if True, the PCA detectors save their fitted model next to the autoencoder model, to be memory-mapped back with load_pca_model()
+    - lookup_table: if True, the fitted models score every possible binary row once, and the data is scored by a table lookup
     """
     
-    def __init__(self,data_name,folder_path,data_path,n_components,encoder_hidden_layers, decoder_hidden_layers, is_image_data=True,img_height=0,img_width=0,k=20, replicate_for_training = 0,model_path='model_autoencoder.h5'):
+    def __init__(self,data_name,folder_path,data_path,n_components,encoder_hidden_layers, decoder_hidden_layers, is_image_data=True,img_height=0,img_width=0,k=20, replicate_for_training = 0,model_path='model_autoencoder.h5',store_path='store/',cache_path='cache/',dedup=False,lookup_table=False,pca_solver='full',chunk_size=None,pca_cache=True,save_pca_model=False,dtype=None,covariance_estimator='cv',threshold_folds=None,cv_workers=1):
         self.data_name = data_name
         self.folder_path = folder_path # String
         self.data_path = folder_path + data_path # String
@@ -29,6 +41,18 @@ class AnomalyData:
         self.k = k # int: a parameter to be used in Precision@k
         self.replicate_for_training = replicate_for_training # Integer
         self.model_path = folder_path + model_path # String
+        self.store_path = self.data_path + store_path # String
+        self.cache_path = folder_path + cache_path # String
+        self.dedup = dedup # Boolean
+        self.lookup_table = lookup_table # Boolean
+        self.pca_solver = pca_solver # String: 'full', 'eigsh' or 'randomized'
+        self.chunk_size = chunk_size # int or None
+        self.pca_cache = pca_cache # Boolean
+        self.save_pca_model = save_pca_model # Boolean
+        self.dtype = dtype # numpy float type or None
+        self.covariance_estimator = covariance_estimator # String: 'cv', 'ledoit_wolf' or 'oas'
+        self.threshold_folds = threshold_folds # int or None
+        self.cv_workers = cv_workers # int
 
 def set_mnist():
     """
@@ -59,7 +83,7 @@ def set_faces():
     is_image_data = True
     k = 10
     replicate_for_training = 300
-    faces = AnomalyData(data_name,folder_path,data_path,n_components,encoder_hidden_layers, decoder_hidden_layers,is_image_data=is_image_data,k=k,n_layers=n_layers,replicate_for_training=replicate_for_training,multiplier=multiplier)
+    faces = AnomalyData(data_name,folder_path,data_path,n_components,encoder_hidden_layers, decoder_hidden_layers,is_image_data=is_image_data,k=k,replicate_for_training=replicate_for_training)
     return faces
 
 def set_synthetic(folder_path):
@@ -69,5 +93,7 @@ def set_synthetic(folder_path):
     encoder_hidden_layers = np.array([13,11,9]) # input dimension is 16
     decoder_hidden_layers = np.array([9,11,13])
     is_image_data = False
-    synthetic = AnomalyData(data_name,folder_path,data_path,n_components, encoder_hidden_layers, decoder_hidden_layers,is_image_data=is_image_data,n_layers=n_layers,multiplier=multiplier)
+    dedup = True # At most 2^16 distinct rows
+    lookup_table = True # Score the 2^16 possible rows once
+    synthetic = AnomalyData(data_name,folder_path,data_path,n_components, encoder_hidden_layers, decoder_hidden_layers,is_image_data=is_image_data,dedup=dedup,lookup_table=lookup_table)
     return synthetic
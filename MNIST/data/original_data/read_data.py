@@ -6,14 +6,16 @@ from __future__ import print_function
 import gzip
 import os
 import sys
-import time
 
 from six.moves import urllib
 from six.moves import xrange  # pylint: disable=redefined-builtin
-from scipy.misc import imsave
 import tensorflow as tf
 import numpy as np
-import csv
+
+# The batch resampling helpers live in data_store.py at the root of the repository
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.insert(0, ROOT_DIRECTORY)
+from data_store import resize_batch
 
 SOURCE_URL = 'http://yann.lecun.com/exdb/mnist/'
 # WORK_DIRECTORY = 'data'
@@ -22,6 +24,10 @@ IMAGE_SIZE = 28
 NUM_CHANNELS = 1
 PIXEL_DEPTH = 255
 NUM_LABELS = 10
+OUTPUT_SIZE = 32 # Height and width of the images saved in input_data/imgs_*.npy
+PYRAMID_SIZES = [28, 32] # Every size saved in input_data/; sizes other than OUTPUT_SIZE go to imgs_*_<size>.npy
+OUTPUT_DIRECTORY = '../input_data/'
+CHUNK_SIZE = 10000 # Number of images decoded and resized per batch
 
 def maybe_download(filename):
   """Download the data from Yann's website, unless it's already here."""
@@ -36,57 +42,73 @@ def maybe_download(filename):
   return filepath
 
 
-def extract_data(filename, num_images):
-  """Extract the images into a 4D tensor [image index, y, x, channels].
-  Values are rescaled from [0, 255] down to [-0.5, 0.5].
-  """
-  print('Extracting', filename)
+def read_idx_header(bytestream):
+  """Read the header of an IDX file and return the shape of the array it holds."""
+  magic = np.frombuffer(bytestream.read(4), dtype=np.uint8)
+  if magic[0] != 0 or magic[1] != 0 or magic[2] != 0x08:
+    raise ValueError('Not an unsigned byte IDX file')
+  n_dims = int(magic[3])
+  return tuple(int(d) for d in np.frombuffer(bytestream.read(4 * n_dims), dtype='>i4'))
+
+
+def iter_idx_chunks(filename, chunk_size=CHUNK_SIZE):
+  """Stream a gzip IDX file as uint8 arrays of at most chunk_size items."""
   with gzip.open(filename) as bytestream:
-    bytestream.read(16)
-    buf = bytestream.read(IMAGE_SIZE * IMAGE_SIZE * num_images)
-    data = np.frombuffer(buf, dtype=np.uint8).astype(np.float32)
-    #data = (data - (PIXEL_DEPTH / 2.0)) / PIXEL_DEPTH
-    data = data.reshape(num_images, IMAGE_SIZE, IMAGE_SIZE, 1)
-    return data
+    shape = read_idx_header(bytestream)
+    item_shape = shape[1:]
+    item_size = int(np.prod(item_shape))
+    for start in xrange(0, shape[0], chunk_size):
+      n_items = min(chunk_size, shape[0] - start)
+      buf = bytestream.read(item_size * n_items)
+      yield start, np.frombuffer(buf, dtype=np.uint8).reshape((n_items,) + item_shape)
 
 
-def extract_labels(filename, num_images):
-  """Extract the labels into a vector of int64 label IDs."""
-  print('Extracting', filename)
+def read_idx_shape(filename):
+  """Read only the shape stored in the header of a gzip IDX file."""
   with gzip.open(filename) as bytestream:
-    bytestream.read(8)
-    buf = bytestream.read(1 * num_images)
-    labels = np.frombuffer(buf, dtype=np.uint8).astype(np.int64)
-  return labels
-
-train_data_filename = maybe_download('train-images-idx3-ubyte.gz')
-train_labels_filename = maybe_download('train-labels-idx1-ubyte.gz')
-test_data_filename = maybe_download('t10k-images-idx3-ubyte.gz')
-test_labels_filename = maybe_download('t10k-labels-idx1-ubyte.gz')
-
-# Extract it into np arrays.
-train_data = extract_data(train_data_filename, 60000)
-train_labels = extract_labels(train_labels_filename, 60000)
-test_data = extract_data(test_data_filename, 10000)
-test_labels = extract_labels(test_labels_filename, 10000)
-
-if not os.path.isdir("mnist/train-images"):
-   os.makedirs("mnist/train-images")
-
-if not os.path.isdir("mnist/test-images"):
-   os.makedirs("mnist/test-images")
-
-# process train data
-with open("mnist/train-labels.csv", 'w') as csvFile:
-  writer = csv.writer(csvFile, delimiter=',', quotechar='"')
-  for i in range(len(train_data)):
-    imsave("mnist/train-images/" + str(i) + ".jpg", train_data[i][:,:,0])
-    writer.writerow(["train-images/" + str(i) + ".jpg", train_labels[i]])
-
-
-# repeat for test data
-with open("mnist/test-labels.csv", 'w') as csvFile:
-  writer = csv.writer(csvFile, delimiter=',', quotechar='"')
-  for i in range(len(test_data)):
-    imsave("mnist/test-images/" + str(i) + ".jpg", test_data[i][:,:,0])
-    writer.writerow(["test-images/" + str(i) + ".jpg", test_labels[i]])
\ No newline at end of file
+    return read_idx_header(bytestream)
+
+
+def pyramid_fname(prefix, size):
+  """File name of the images of one size: the OUTPUT_SIZE images keep the plain name."""
+  if size == OUTPUT_SIZE:
+    return prefix + '.npy'
+  return prefix + '_' + str(size) + '.npy'
+
+
+def convert_idx_to_npy(images_filename, labels_filename, images_prefix, labels_out,
+                       sizes=PYRAMID_SIZES, chunk_size=CHUNK_SIZE):
+  """Convert a pair of gzip IDX files into the input_data/*.npy arrays in one pass.
+
+  The images are read chunk by chunk, resized as a batch to every size in
+  sizes, and written into preallocated uint8 .npy memmaps: no per-image file,
+  no JPEG round trip, and each image is decoded only once for all the sizes.
+  """
+  print('Converting', images_filename)
+  n_images = read_idx_shape(images_filename)[0]
+  pyramid = {}
+  for size in sizes:
+    pyramid[size] = np.lib.format.open_memmap(pyramid_fname(images_prefix, size), mode='w+',
+                                              dtype=np.uint8, shape=(n_images, size, size))
+  for start, chunk in iter_idx_chunks(images_filename, chunk_size):
+    for size, imgs in pyramid.items():
+      imgs[start:start + len(chunk)] = resize_batch(chunk, size, size)
+  for imgs in pyramid.values():
+    imgs.flush()
+  del pyramid
+
+  labels = np.concatenate([chunk for _, chunk in iter_idx_chunks(labels_filename, chunk_size)])
+  np.save(labels_out, labels.astype(np.int64))
+
+
+if __name__ == '__main__':
+  train_data_filename = maybe_download('train-images-idx3-ubyte.gz')
+  train_labels_filename = maybe_download('train-labels-idx1-ubyte.gz')
+  test_data_filename = maybe_download('t10k-images-idx3-ubyte.gz')
+  test_labels_filename = maybe_download('t10k-labels-idx1-ubyte.gz')
+
+  # Write the final arrays directly
+  convert_idx_to_npy(train_data_filename, train_labels_filename,
+                     OUTPUT_DIRECTORY + 'imgs_train', OUTPUT_DIRECTORY + 'labels_train.npy')
+  convert_idx_to_npy(test_data_filename, test_labels_filename,
+                     OUTPUT_DIRECTORY + 'imgs_test', OUTPUT_DIRECTORY + 'labels_test.npy')
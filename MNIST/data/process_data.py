@@ -1,46 +1,119 @@
 import pandas as pd
 import numpy as np
 import cv2
+import time
+import os
+import sys
+from multiprocessing import Pool, cpu_count
+
+# The batch resampling helpers live in data_store.py at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from data_store import resize_batch
 
 data_path = 'extracted_data/'
 save_path = 'input_data/'
 
+n_workers = cpu_count() # Number of processes that decode the images; set to 1 to read the images serially
+chunk_size = 1000 # Number of images decoded by one worker per task
+
+
+def read_img(path, dim = None):
+    '''
+    This function reads one image and converts it to gray scale; it is resized only if dim is given
+    '''
+    im = cv2.imread(data_path + path)
+    im = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) # Convert from 3-color to gray scale
+    if dim is not None:
+        im = cv2.resize(im,dim,interpolation = cv2.INTER_AREA) # Resize the image
+    return im
+
+def read_imgs_batch(paths, dim = (32,32)):
+    '''
+    This function decodes the images at their original size and resizes them as one stacked batch
+    '''
+    imgs = np.stack([read_img(path) for path in paths])
+    return resize_batch(imgs, dim[1], dim[0]) # cv2 takes dim as width * height
 
 def read_imgs(paths, dim = (32,32)):
     '''
-    This function read images in the given path and return in a list
+    This function read images in the given path and return in an array
     '''
     print("Start Reading Images")
-    imgs = []
-    for path in paths:
-        im = cv2.imread(data_path + path)
-        im = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) # Convert from 3-color to gray scale
-        resized = cv2.resize(im,dim,interpolation = cv2.INTER_AREA) # Resize the image
-        imgs.append(resized)
-    imgs = np.asarray(imgs)
+    paths = list(paths)
+    imgs = np.empty((len(paths), dim[1], dim[0]), dtype=np.uint8)
+    for start in range(0, len(paths), chunk_size):
+        imgs[start:start + chunk_size] = read_imgs_batch(paths[start:start + chunk_size], dim)
     print("Finish Reading Images")
     return imgs
 
+def init_worker():
+    '''
+    Keep OpenCV single-threaded inside each worker: the parallelism comes from the process pool
+    '''
+    cv2.setNumThreads(1)
+
+def read_imgs_chunk(task):
+    '''
+    Worker task: decode a chunk of images, resize it as one batch and write it straight into the output memmap
+    task: (output file name, index of the first image, paths of the chunk, dim)
+    '''
+    out_fname, start, paths, dim = task
+    imgs = np.load(out_fname, mmap_mode='r+') # Open the preallocated output array
+    imgs[start:start + len(paths)] = read_imgs_batch(paths, dim)
+    imgs.flush()
+    del imgs
+    return len(paths)
+
+def read_imgs_parallel(paths, out_fname, dim = (32,32), n_workers = n_workers, chunk_size = chunk_size):
+    '''
+    This function reads the images in the given paths with a process pool.
+    The output is preallocated as a uint8 .npy memmap, and every worker writes its chunk into it directly,
+    so no image list is built and nothing is pickled back to the main process except a count.
+    '''
+    print("Start Reading Images with " + str(n_workers) + " workers")
+    paths = list(paths)
+    n_imgs = len(paths)
+    # Preallocate the output array: shape n * height * width (cv2 takes dim as width * height)
+    imgs = np.lib.format.open_memmap(out_fname, mode='w+', dtype=np.uint8, shape=(n_imgs, dim[1], dim[0]))
+    del imgs # The header is written; the workers open the file themselves
+
+    tasks = [(out_fname, start, paths[start:start + chunk_size], dim) for start in range(0, n_imgs, chunk_size)]
+    time_start = time.time()
+    n_done = 0
+    with Pool(n_workers, initializer=init_worker) as pool:
+        for n_chunk in pool.imap_unordered(read_imgs_chunk, tasks):
+            n_done += n_chunk
+            time_elapsed = max(time.time() - time_start, 1e-6)
+            print("Read {0}/{1} images ({2:.0f} images/s)".format(n_done, n_imgs, n_done / time_elapsed))
+    print("Finish Reading Images in {0:.1f}s".format(time.time() - time_start))
+    return np.load(out_fname, mmap_mode='r')
+
 
-# Read Training Set Labels
-data_train = pd.read_csv(data_path + 'train-labels.csv',header =None)
-paths_train = data_train[0]
-labels_train = data_train[1]
+if __name__ == '__main__':
+    # Read Training Set Labels
+    data_train = pd.read_csv(data_path + 'train-labels.csv',header =None)
+    paths_train = data_train[0]
+    labels_train = data_train[1]
 
-# Read Testing Set Labels
-data_test = pd.read_csv(data_path + 'test-labels.csv',header =None)
-paths_test = data_test[0]
-labels_test = data_test[1]
+    # Read Testing Set Labels
+    data_test = pd.read_csv(data_path + 'test-labels.csv',header =None)
+    paths_test = data_test[0]
+    labels_test = data_test[1]
 
-# Read Training Set Images
-imgs_train = read_imgs(paths_train)
+    if n_workers > 1:
+        # Read the images in parallel: they are written straight into the .npy files
+        imgs_train = read_imgs_parallel(paths_train, save_path + 'imgs_train.npy')
+        imgs_test = read_imgs_parallel(paths_test, save_path + 'imgs_test.npy')
+    else:
+        # Read Training Set Images
+        imgs_train = read_imgs(paths_train)
 
-# Read Test Set Images
-imgs_test = read_imgs(paths_test)
+        # Read Test Set Images
+        imgs_test = read_imgs(paths_test)
 
-# Save Arraylist
-np.save(save_path + 'imgs_train.npy',imgs_train)
-np.save(save_path + 'imgs_test.npy',imgs_test)
-np.save(save_path + 'labels_train.npy',labels_train)
-np.save(save_path + 'labels_test.npy',labels_test)
+        # Save Arraylist
+        np.save(save_path + 'imgs_train.npy',imgs_train)
+        np.save(save_path + 'imgs_test.npy',imgs_test)
 
+    np.save(save_path + 'labels_train.npy',labels_train)
+    np.save(save_path + 'labels_test.npy',labels_test)
@@ -1,43 +1,34 @@
 import numpy as np
-import random
-import matplotlib.pyplot as plt
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+rootdir = os.path.dirname(os.path.dirname(currentdir))
+sys.path.insert(0,rootdir) 
+from synthetic_data import *
 
-# Generate 100K numbers, each of which has 16 digits
+# Generate 100K numbers (or many more: n_samples can go to 10^8+), each of which has 16 digits
 # Anomaly: number of 1s is less than 4
 
 # Set Parameteres
 Anomaly_Threshold = 4 # Anomaly if total # 1s is less than the threshold
-
-# Generate dataset
-np.random.seed(9001)
 n_dimensions = 16
 n_samples = 10**5
-
-mu = np.random.rand(n_dimensions) # Random vector for mean
-cov = np.random.rand(n_dimensions,n_dimensions) # Random matrix for covaraince
-data_mg = np.random.multivariate_normal(mu, cov, size=n_samples) # Generate a random matrix with multivariate normal distribution
-
-data_bi = data_mg >= 0.5 # Convert to binary - True if the data is larger than 0.5; otherwise 0
-data = data_bi*1 # Convert True/False to 1/0
-
-# Label Anomaly if the number of 1s is less than the threshold
-data_rowsum = np.sum(data,axis = 1)
-labels = data_rowsum < Anomaly_Threshold # Anomaly if total # 1s is less than the threshold
-labels = labels*1
-
-print("Percentage of Anomaly in the dataset: " + str(np.sum(labels)/len(labels))) # Find percentage of anomaly in the dataset
-print(data[labels == 1][:5]) # Print the first 5 rows of anomaly data as examples
-
-
-if np.sum(labels)/len(labels) > 0.2:
-    print("Too much anomaly: start cleaning!")
-    labels_remove = (labels==1) & (np.random.rand(n_samples) <= 0.6) # Remove around 60% of anomalies
-    print(str(sum(labels_remove)) +' Anomalies are going to be removed.')
-    data = data[~labels_remove] # Remove the selected data
-    labels = labels[~labels_remove] # Remove the corresponding labels
-    print("Percentage of Anomaly in the dataset after cleaning: " + str(np.sum(labels)/len(labels))) # Find percentage of anomaly in the dataset
-
-# Save the data and labels
-np.save('data.npy',data)
-np.save('labels.npy',labels)
-print('Data and Labels have been saved!')
\ No newline at end of file
+store_path = 'store/' # Dataset store read by read_synthetic_data()
+chunk_preview = 10**4 # Rows searched for the anomaly examples
+
+config = {
+    'n_dimensions': n_dimensions,
+    'label_rule': 'row_sum',
+    'anomaly_threshold': Anomaly_Threshold,
+    'max_anomaly_ratio': 0.2, # If there is too much anomaly,
+    'remove_anomaly_ratio': 0.6, # remove around 60% of anomalies
+    'seed': 9001,
+}
+
+if __name__ == '__main__':
+    # Generate the dataset chunk by chunk; the rows are saved bit-packed in the dataset store
+    store = generate_synthetic_store(store_path, n_samples, **config)
+
+    # Print the first 5 rows of anomaly data as examples
+    ind_anomaly = np.flatnonzero(store['labels'][:chunk_preview])[:5]
+    print(read_binary_rows(store, ind_anomaly))
+    print('Data and Labels have been saved!')
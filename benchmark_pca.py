@@ -0,0 +1,74 @@
+import time
+import numpy as np
+from support_functions import *
+
+## Benchmark of the PCA eigensolvers of compute_pca_matrix()
+# Data shaped like the MNIST training set (60000 * 1024) with 200 components; set use_mnist to False
+# to run on random data with a decaying spectrum of the same shape
+use_mnist = True
+n_samples = 60000
+n_features = 1024
+n_components = 200
+n_repeats = 3
+
+def legacy_pca_matrix(data):
+    """
+    The previous compute_pca_matrix(): general eigensolver, then a sort of (eigenvalue, eigenvector) tuples in Python
+    """
+    n_features = data.shape[1]
+    component_mean = np.mean(data,axis = 0)
+    data_shifted = mean_shift(data,component_mean)
+    cov_matrix = np.cov(data_shifted, rowvar=0)
+    eigen_value, eigen_vector = np.linalg.eig(cov_matrix)
+    eig_pairs = [(np.abs(eigen_value[i]), eigen_vector[:,i]) for i in range(len(eigen_value))]
+    eig_pairs.sort(key=lambda x: x[0], reverse=True)
+    pca_matrix = np.zeros((n_features,n_features))
+    for i in range(0,len(eig_pairs)):
+        pca_matrix[:,i] = eig_pairs[i][1]
+    return pca_matrix, component_mean
+
+def random_spectrum_data(n_samples,n_features):
+    """
+    Random data whose variance decays along random orthogonal directions, like natural images
+    """
+    basis, _ = np.linalg.qr(np.random.standard_normal((n_features,n_features)))
+    scales = 1.0 / np.arange(1,n_features+1)
+    return (np.random.standard_normal((n_samples,n_features)) * scales).dot(basis.T)
+
+def time_solver(fit_func,data):
+    """
+    Best time out of n_repeats fits
+    """
+    times = []
+    for i in range(n_repeats):
+        time_start = time.time()
+        pca_matrix, component_mean = fit_func(data)
+        times.append(time.time() - time_start)
+    return min(times), pca_matrix, component_mean
+
+def reconstruction_error(data,pca_matrix,component_mean):
+    """
+    Mean reconstruction error of the data with the top n_components
+    """
+    data_pca = reconstruct_with_pca(data,component_mean,pca_matrix,n_components)
+    return np.mean(find_euclidean_distance(data_pca,data))
+
+if __name__ == '__main__':
+    if use_mnist:
+        mnist, data, imgs_test, labels_train, labels_test = read_mnist_data()
+        data = np.asarray(data, dtype = np.float64)
+    else:
+        data = random_spectrum_data(n_samples,n_features)
+    print('Data: {0} * {1}, {2} components'.format(data.shape[0],data.shape[1],n_components))
+
+    solvers = [('legacy eig', legacy_pca_matrix)]
+    for solver in pca_solvers:
+        solvers.append((solver, lambda data, solver=solver: compute_pca_matrix(data,n_components=n_components,solver=solver)))
+
+    error_reference = None
+    for name, fit_func in solvers:
+        time_fit, pca_matrix, component_mean = time_solver(fit_func,data)
+        error = reconstruction_error(data,pca_matrix,component_mean)
+        if error_reference is None:
+            error_reference = error
+        print('{0:>12}: {1:7.3f}s, basis {2}, reconstruction error {3:.6f} ({4:+.2e} relative)'.format(name, time_fit, pca_matrix.shape, error, error/error_reference - 1))
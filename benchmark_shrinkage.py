@@ -0,0 +1,45 @@
+import time
+from support_functions import *
+
+## Benchmark of the covariance estimators of the Autoencoder Gaussian detector
+# Every dataset is encoded once with its saved autoencoder; the Gaussian is then fitted and tested with the
+# cross-validated whitening ('cv') and with the closed-form shrinkage, to compare the fit time and the R-Precision
+read_funcs = [read_mnist_data,get_yale_faces_data,read_synthetic_data,read_synthetic_data,read_synthetic_data,read_synthetic_data]
+parameters = ['','','Synthetic/','Synthetic_2/','Synthetic_3/','Synthetic_4/']
+estimators = ['cv'] + shrinkage_methods
+n_runs = 3
+
+def encode_dataset(read_func,param):
+    """
+    Read a dataset and encode its training and testing set with the saved autoencoder
+    """
+    if len(param) == 0: # no parameter
+        AnomalyData, data_train, data_test, labels_train, labels_test = read_func()
+    else:
+        AnomalyData, data_train, data_test, labels_train, labels_test = read_func(param)
+    autoencoder, encoder = load_encoder(AnomalyData)
+    data_train_encoded = encode_data(encoder, data_train)
+    data_test_encoded = encode_data(encoder, data_test)
+    return AnomalyData, data_train_encoded, data_test_encoded, labels_train, labels_test
+
+def compare_estimators(data_train_encoded,data_test_encoded,labels_train,labels_test,k):
+    """
+    Best fit-and-test time out of n_runs and the R-Precision of each covariance estimator
+    """
+    rows = []
+    for estimator in estimators:
+        shrinkage = None if estimator == 'cv' else estimator
+        times = []
+        for run in range(n_runs):
+            time_start = time.time()
+            results = train_test_with_gaussian(data_train_encoded, data_test_encoded, labels_train, labels_test, k, whitened = True, to_print = False, shrinkage = shrinkage)
+            times.append(time.time() - time_start)
+        rows.append((estimator, min(times), results.RPrec))
+    return rows
+
+if __name__ == '__main__':
+    for read_func, param in zip(read_funcs, parameters):
+        AnomalyData, data_train_encoded, data_test_encoded, labels_train, labels_test = encode_dataset(read_func,param)
+        print('{0}: {1} * {2} encoded'.format(AnomalyData.data_name, data_train_encoded.shape[0], data_train_encoded.shape[1]))
+        for estimator, time_fit, rprec in compare_estimators(data_train_encoded,data_test_encoded,labels_train,labels_test,AnomalyData.k):
+            print('{0:>12}: {1:7.3f}s, R-Precision {2:.1f}%'.format(estimator, time_fit, rprec * 100))
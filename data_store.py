@@ -0,0 +1,267 @@
+import numpy as np
+import json
+import os
+
+# File name of the JSON header inside a dataset store folder
+store_header_fname = 'header.json'
+
+class DatasetStore:
+    """
+    Class to access a dataset store: a folder of raw arrays described by a JSON header.
+    Every array is opened with memory mapping, so nothing is read into RAM until it is used.
+    Parameters:
+    - store_path: the path of the folder that holds the header and the raw array files
+    - header: the parsed JSON header (file, shape and dtype of every array, and the label index)
+    - arrays: a dictionary of read-only memory-mapped arrays, keyed by the array name
+    """
+
+    def __init__(self,store_path):
+        self.store_path = store_path # String
+        self.header = read_store_header(store_path) # Dictionary
+        self.arrays = {} # Dictionary: array name -> np.memmap
+        for name, entry in self.header['arrays'].items():
+            self.arrays[name] = np.memmap(os.path.join(store_path, entry['file']), dtype=np.dtype(entry['dtype']), mode='r', shape=tuple(entry['shape']))
+
+    def __getitem__(self,name):
+        return self.arrays[name]
+
+    def __contains__(self,name):
+        return name in self.arrays
+
+    def labels_of(self,name):
+        """
+        Return the labels array that belongs to the data array 'name', based on the label index
+        """
+        return self.arrays[self.header['label_index'][name]['labels']]
+
+    def attributes(self,name):
+        """
+        Return the attributes saved with the array 'name' (an empty dictionary if there is none)
+        """
+        return self.header['arrays'][name].get('attributes', {})
+
+    def label_counts(self,name):
+        """
+        Return the number of rows per label value of the data array 'name', without reading the labels
+        """
+        return self.header['label_index'][name]['counts']
+
+
+def has_dataset_store(store_path):
+    """
+    Check if a dataset store has been built in the given folder
+    """
+    return os.path.isfile(os.path.join(store_path, store_header_fname))
+
+def read_store_header(store_path):
+    """
+    Read the JSON header of a dataset store; an empty header is returned if the store does not exist yet
+    """
+    header_path = os.path.join(store_path, store_header_fname)
+    if not os.path.isfile(header_path):
+        return {'arrays': {}, 'label_index': {}}
+    with open(header_path) as f:
+        header = json.load(f)
+    return header
+
+def write_store_header(store_path,header):
+    """
+    Write the JSON header of a dataset store; the file is replaced atomically so readers never see a partial header
+    """
+    header_path = os.path.join(store_path, store_header_fname)
+    with open(header_path + '.tmp', 'w') as f:
+        json.dump(header, f, indent=2, sort_keys=True)
+    os.replace(header_path + '.tmp', header_path)
+
+def open_dataset_store(store_path):
+    """
+    Open a dataset store for reading: all arrays are memory-mapped views into the raw files
+    """
+    return DatasetStore(store_path)
+
+def create_store_array(store_path,name,shape,dtype,attributes=None):
+    """
+    Allocate a new raw array in the dataset store and return it as a writable memory map.
+    The header entry is recorded right away, so writers can fill the array chunk by chunk.
+    - name: the name of the array (also used for the raw file name)
+    - shape: the shape of the array
+    - dtype: the numpy dtype stored on disk (e.g. uint8 for images, bool for anomaly labels)
+    - attributes: an optional dictionary saved with the array in the header (e.g. how the rows are packed)
+    """
+    os.makedirs(store_path, exist_ok=True)
+    dtype = np.dtype(dtype)
+    shape = tuple(int(s) for s in shape)
+    fname = name + '.bin'
+    array = np.memmap(os.path.join(store_path, fname), dtype=dtype, mode='w+', shape=shape)
+
+    header = read_store_header(store_path)
+    header['arrays'][name] = {'file': fname, 'shape': list(shape), 'dtype': dtype.str, 'attributes': attributes or {}}
+    write_store_header(store_path, header)
+    return array
+
+def open_store_array(store_path,name,mode='r+'):
+    """
+    Open one array of the dataset store as a memory map; mode 'r+' lets a worker process write into it
+    """
+    entry = read_store_header(store_path)['arrays'][name]
+    return np.memmap(os.path.join(store_path, entry['file']), dtype=np.dtype(entry['dtype']), mode=mode, shape=tuple(entry['shape']))
+
+def resize_store_array(store_path,name,n_rows):
+    """
+    Shrink an array of the dataset store to its first n_rows rows, and truncate the raw file accordingly
+    """
+    header = read_store_header(store_path)
+    entry = header['arrays'][name]
+    shape = [int(n_rows)] + entry['shape'][1:]
+    row_bytes = np.dtype(entry['dtype']).itemsize * int(np.prod(shape[1:]))
+    os.truncate(os.path.join(store_path, entry['file']), row_bytes * int(n_rows))
+    entry['shape'] = shape
+    write_store_header(store_path, header)
+
+def save_store_array(store_path,name,array,dtype=None,chunk_rows=2**20):
+    """
+    Copy an array (e.g. a .npy file opened with mmap_mode='r') into the dataset store chunk by chunk,
+    so that the peak memory is bounded by chunk_rows regardless of the size of the array
+    """
+    if dtype is None:
+        dtype = compact_dtype(array,chunk_rows)
+    stored = create_store_array(store_path, name, array.shape, dtype)
+    for start in range(0, len(array), chunk_rows):
+        end = min(start + chunk_rows, len(array))
+        stored[start:end] = array[start:end]
+    stored.flush()
+    return stored
+
+def set_store_labels(store_path,data_name,labels_name):
+    """
+    Record in the label index that the array 'labels_name' holds the labels of the array 'data_name'.
+    The counts of each label value are saved as well, so the class balance is known without reading the data.
+    """
+    header = read_store_header(store_path)
+    entry = header['arrays'][labels_name]
+    labels = np.memmap(os.path.join(store_path, entry['file']), dtype=np.dtype(entry['dtype']), mode='r', shape=tuple(entry['shape']))
+    values, counts = np.unique(labels, return_counts=True)
+    header['label_index'][data_name] = {
+        'labels': labels_name,
+        'counts': {str(value.item()): int(count) for value, count in zip(values, counts)},
+    }
+    write_store_header(store_path, header)
+
+def compact_dtype(array,chunk_rows=2**20):
+    """
+    Find the smallest on-disk dtype for the array: bool for 0/1 labels, uint8 for binary data and 8-bit images
+    The values are checked chunk_rows rows at a time (e.g. on a memory map), and the scan stops as soon as
+    no smaller dtype fits, so the peak memory is bounded by chunk_rows as in save_store_array()
+    """
+    if array.dtype == np.bool_ or array.dtype == np.uint8:
+        return array.dtype
+    is_integer = np.issubdtype(array.dtype, np.integer)
+    fits_bool = array.ndim == 1 # Anomaly labels: a vector of 0/1
+    fits_uint8 = is_integer or np.issubdtype(array.dtype, np.floating) # Binary vectors, pixels and digit labels
+    for start in range(0, len(array), chunk_rows):
+        if not (fits_bool or fits_uint8):
+            break
+        chunk = np.asarray(array[start:start+chunk_rows])
+        if fits_bool:
+            fits_bool = bool(np.all((chunk == 0) | (chunk == 1)))
+        if fits_uint8:
+            fits_uint8 = chunk.size == 0 or (chunk.min() >= 0 and chunk.max() <= 255)
+            if fits_uint8 and not is_integer:
+                fits_uint8 = bool(np.all(np.mod(chunk, 1) == 0))
+    if fits_bool:
+        return np.dtype(np.bool_)
+    if fits_uint8:
+        return np.dtype(np.uint8)
+    return array.dtype # Keep the original dtype
+
+def convert_npy_to_store(store_path,npy_paths,labels_of=None):
+    """
+    Build a dataset store from existing .npy files
+    - npy_paths: a dictionary of array name -> .npy path
+    - labels_of: a dictionary of data array name -> labels array name, used to build the label index
+    """
+    for name, npy_path in npy_paths.items():
+        array = np.load(npy_path, mmap_mode='r') # Do not read the whole file into RAM
+        save_store_array(store_path, name, array)
+    for data_name, labels_name in (labels_of or {}).items():
+        set_store_labels(store_path, data_name, labels_name)
+    return open_dataset_store(store_path)
+
+## Bit-packed binary rows
+def packed_dtype(n_dimensions):
+    """
+    The smallest unsigned integer type that holds one binary row of n_dimensions bits
+    """
+    for dtype in [np.uint8, np.uint16, np.uint32, np.uint64]:
+        if n_dimensions <= 8*np.dtype(dtype).itemsize:
+            return np.dtype(dtype)
+    raise ValueError('Binary rows longer than 64 dimensions cannot be packed into one integer')
+
+def pack_binary_rows(bits):
+    """
+    Pack binary rows (m*n, values 0/1) into one integer per row; the first dimension is the most significant bit
+    """
+    n_dimensions = bits.shape[1]
+    dtype = packed_dtype(n_dimensions)
+    weights = (np.ones(1, dtype=dtype) << np.arange(n_dimensions-1, -1, -1, dtype=dtype)) # 2^(n-1), ..., 2, 1
+    return np.asarray(bits, dtype=bool).astype(dtype).dot(weights).astype(dtype)
+
+def unpack_binary_rows(codes,n_dimensions,dtype=np.uint8):
+    """
+    Unpack integer codes back into binary rows of size m*n_dimensions
+    """
+    codes = np.asarray(codes)
+    shifts = np.arange(n_dimensions-1, -1, -1, dtype=codes.dtype)
+    return ((codes[:,None] >> shifts) & 1).astype(dtype)
+
+
+## Batch image resampling
+def linear_resize_matrix(n_in,n_out):
+    """
+    Build the n_out*n_in matrix of a 1-D linear interpolation (pixel centers aligned, as in cv2.INTER_LINEAR)
+    """
+    matrix = np.zeros((n_out,n_in))
+    src = (np.arange(n_out) + 0.5) * n_in / n_out - 0.5 # Position of each output pixel in the input
+    src = np.clip(src, 0, n_in - 1)
+    left = np.floor(src).astype(int)
+    right = np.minimum(left + 1, n_in - 1)
+    weight = src - left
+    rows = np.arange(n_out)
+    np.add.at(matrix, (rows,left), 1 - weight)
+    np.add.at(matrix, (rows,right), weight)
+    return matrix
+
+def area_resize_matrix(n_in,n_out):
+    """
+    Build the n_out*n_in matrix of a 1-D area average (as in cv2.INTER_AREA when shrinking):
+    each output pixel is the mean of the input pixels it covers, weighted by the overlap
+    """
+    edges = np.arange(n_out + 1) * n_in / n_out # Boundaries of each output pixel in the input
+    lower = np.maximum(edges[:-1,None], np.arange(n_in)[None,:])
+    upper = np.minimum(edges[1:,None], np.arange(n_in)[None,:] + 1)
+    overlap = np.maximum(upper - lower, 0)
+    return overlap / (n_in / n_out)
+
+def resize_matrix(n_in,n_out):
+    """
+    Area average to shrink, linear interpolation to enlarge
+    """
+    if n_out < n_in:
+        return area_resize_matrix(n_in,n_out)
+    return linear_resize_matrix(n_in,n_out)
+
+def resize_batch(imgs,height,width,dtype=np.uint8):
+    """
+    Resize a stacked batch of images (n*h*w) at once with a separable kernel: imgs_resized = Ry * img * Rx^T
+    The result is rounded back to uint8 unless another dtype is given
+    """
+    n_imgs, h, w = imgs.shape
+    if (h,w) == (height,width):
+        return np.asarray(imgs, dtype=dtype)
+    resize_y = resize_matrix(h,height).astype(np.float32)
+    resize_x = resize_matrix(w,width).astype(np.float32)
+    imgs_resized = np.matmul(np.matmul(resize_y, imgs.astype(np.float32)), resize_x.T)
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        info = np.iinfo(dtype)
+        imgs_resized = np.clip(np.rint(imgs_resized), info.min, info.max)
+    return imgs_resized.astype(dtype)
@@ -4,21 +4,30 @@ import matplotlib.pyplot as plt
 from PIL import Image
 from scipy.io import loadmat  
 from scipy import stats  
-from scipy.stats import multivariate_normal
+from scipy.linalg import solve_triangular
+from scipy.sparse.linalg import eigsh
 import re
 import glob
 import seaborn as sns
 from operator import itemgetter 
+from collections import OrderedDict
 import random
 from random import shuffle
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count, get_context, shared_memory
 import tensorflow as tf
 
 from keras.layers import Input, Dense
 from keras.models import Model
 from keras.models import load_model
 from keras.backend.tensorflow_backend import set_session
-from sklearn.model_selection import KFold
+from sklearn.model_selection import StratifiedKFold
 from AnomalyDataClass import * # Functions to extract parameters of each data files 
+from data_store import * # Memory-mapped dataset store
+from synthetic_data import * # Chunked generator of the bit-packed synthetic datasets
 
 class Results:
     """
@@ -37,9 +46,10 @@ class Results:
     - tn: # true negative
     - fp: # false positive
     - fn: # false negative
+    - threshold: the threshold selected on the training set (on the reconstruction error or on the gaussian log-density)
     """
     
-    def __init__(self,data_name='',detect_model='',Recall=0.0,Precision=0.0,F=0.0,RPrec=0.0,R=0,PrecK=0.0,k=0,tp=0,tn=0,fp=0,fn=0):
+    def __init__(self,data_name='',detect_model='',Recall=0.0,Precision=0.0,F=0.0,RPrec=0.0,R=0,PrecK=0.0,k=0,tp=0,tn=0,fp=0,fn=0,threshold=0.0):
         self.data_name = data_name # String
         self.detect_model = detect_model # String
         self.Recall = Recall # Double
@@ -53,6 +63,7 @@ class Results:
         self.tn = tn # Integer
         self.fp = fp # Integer
         self.fn = fn # Integer
+        self.threshold = threshold # Double
 
 
 ## Function to Run Detection on any dataset
@@ -75,32 +86,51 @@ def read_and_detect(read_func,detect_func,param_read='',to_print = False):
         return results
 
 ## Functions to Get Data
-def read_mnist_data(anomaly_digit=2):
+def read_mnist_data(anomaly_digit=2,img_size=32):
     """
     Automate the process to read and process the MNIST data
+    The images are kept as uint8 memory-mapped views; they are only converted to float inside the models
+    img_size: the size of the images, one of the sizes written by original_data/read_data.py (28 or 32)
     """
     # Read the mnist as an instance of the AnomalyData class
     mnist = set_mnist()
-
-    # File Names
-    imgs_train_fname = 'input_data/imgs_train.npy'
-    imgs_test_fname = 'input_data/imgs_test.npy'
-    labels_train_fname = 'input_data/labels_train.npy'
-    labels_test_fname = 'input_data/labels_test.npy'
-
-    # Load the data
-    data_path = mnist.data_path # Get the data path
-    imgs_train = np.load(data_path + imgs_train_fname) # images in the training set, with shape: 60000 * 32 * 32
-    imgs_test = np.load(data_path + imgs_test_fname) # images in the testing set, with shape: 10000 * 32 * 32
-
-    labels_train = np.load(data_path + labels_train_fname) # labels in the training set, a vector with length 60000
-    labels_test = np.load(data_path + labels_test_fname) # labels in the test set, a vector with length 10000
+    imgs_train, imgs_test, labels_train, labels_test = read_mnist_images(mnist,img_size)
 
     # Define Anomaly
     # Mark the labels of the target digit as anomaly (1), and others as normal (0)
     labels_anomaly_train = label_anomaly(labels_train, anomaly_digit) 
     labels_anomaly_test = label_anomaly(labels_test, anomaly_digit) 
-    
+
+    return mnist, imgs_train, imgs_test, labels_anomaly_train, labels_anomaly_test
+
+def read_mnist_images(mnist,img_size = 32):
+    """
+    Read the MNIST images as 2-D memory-mapped matrices (one row per image) and the digit labels
+    The height and width of the images are recorded in mnist (an instance of the AnomalyData class)
+    """
+    # Load the data
+    data_path = mnist.data_path # Get the data path
+    imgs_train_name = mnist_imgs_name('imgs_train',img_size)
+    imgs_test_name = mnist_imgs_name('imgs_test',img_size)
+    store = open_dataset_store(mnist.store_path) if has_dataset_store(mnist.store_path) else None
+    if store is not None and imgs_train_name in store: # Use the dataset store if it has been built
+        imgs_train = store[imgs_train_name] # images in the training set, with shape: 60000 * 32 * 32
+        imgs_test = store[imgs_test_name] # images in the testing set, with shape: 10000 * 32 * 32
+        labels_train = store['labels_train'] # labels in the training set, a vector with length 60000
+        labels_test = store['labels_test'] # labels in the test set, a vector with length 10000
+    else:
+        # File Names
+        imgs_train_fname = 'input_data/' + imgs_train_name + '.npy'
+        imgs_test_fname = 'input_data/' + imgs_test_name + '.npy'
+        labels_train_fname = 'input_data/labels_train.npy'
+        labels_test_fname = 'input_data/labels_test.npy'
+
+        # Memory-map the .npy files instead of reading them into RAM
+        imgs_train = np.load(data_path + imgs_train_fname, mmap_mode='r') # images in the training set, with shape: 60000 * 32 * 32
+        imgs_test = np.load(data_path + imgs_test_fname, mmap_mode='r') # images in the testing set, with shape: 10000 * 32 * 32
+        labels_train = np.load(data_path + labels_train_fname, mmap_mode='r') # labels in the training set, a vector with length 60000
+        labels_test = np.load(data_path + labels_test_fname, mmap_mode='r') # labels in the test set, a vector with length 10000
+
     ## Transform to 2-D Matrix
     # Record the dimensions of the image sets
     mnist.img_height = imgs_train.shape[1]
@@ -108,15 +138,45 @@ def read_mnist_data(anomaly_digit=2):
     len_train = len(imgs_train)
     len_test = len(imgs_test)
 
-    # reshape to a 2-D Matrix
+    # reshape to a 2-D Matrix: a view on the memory map, no copy
     imgs_train = imgs_train.reshape(len_train,-1) # reshape to 60000 * 1024
     imgs_test = imgs_test.reshape(len_test,-1) # reshape to 10000 * 1024
 
-    return mnist, imgs_train, imgs_test, labels_anomaly_train, labels_anomaly_test
+    return imgs_train, imgs_test, labels_train, labels_test
+
+def mnist_imgs_name(name,img_size = 32):
+    """
+    Name of the MNIST images of one size: the 32*32 images keep the plain name (e.g. imgs_train, imgs_train_28)
+    """
+    if img_size == 32:
+        return name
+    return name + '_' + str(img_size)
 
-def get_yale_faces_data(reduce_height = 24, reduce_width = 21):
+def build_mnist_store(img_sizes = (28,32)):
+    """
+    Convert the MNIST .npy files into a dataset store with uint8 images (one array per size) and labels
+    """
+    mnist = set_mnist()
+    npy_paths = {}
+    labels_of = {}
+    for name in ['labels_train','labels_test']:
+        npy_paths[name] = mnist.data_path + 'input_data/' + name + '.npy'
+    for img_size in img_sizes:
+        for name, labels_name in [('imgs_train','labels_train'),('imgs_test','labels_test')]:
+            imgs_name = mnist_imgs_name(name,img_size)
+            npy_paths[imgs_name] = mnist.data_path + 'input_data/' + imgs_name + '.npy'
+            labels_of[imgs_name] = labels_name
+    return convert_npy_to_store(mnist.store_path, npy_paths, labels_of)
+
+def get_yale_faces_data(reduce_height = 24, reduce_width = 21, n_workers = cpu_count(), use_cache = True, reuse_split = False):
     """
     Automate the process to read and process the faces data
+    - reduce_height, reduce_width: the size of the images; None keeps the full resolution (192*168),
+      where the PCA is computed through the Gram matrix of the images (see dual_pca_matrix())
+    - n_workers: number of threads used to decode the images
+    - use_cache: if True, the images are loaded from (or saved to) the on-disk resolution pyramid (see read_faces_level())
+    - reuse_split: if True, the training/testing split is saved in the cache folder and reused between runs;
+      off by default, so repeated runs (e.g. Reports/evaluate_results.py) each draw a new split
     """
     # Read the faces as an instance of the AnomalyData Class
     faces = set_faces()
@@ -124,72 +184,96 @@ def get_yale_faces_data(reduce_height = 24, reduce_width = 21):
     # Here we specify the folders for Anomaly and Normal Data
     label_1_folder = [9,21] # Folders that contain the anomaly data
     target_folders = range(1,29) # Folders to extract the image and label data
+    dark_pixel_threshold = 180 # Images with more dark pixels are removed (counted on the 24*21 images)
 
-    # Read the images and reduce the size
+    # Read the images at the requested size
     # We also need to reduce the size of the image for the convenience of computation
-    imgs,labels = read_faces_images(faces.data_path,target_folders,label_1_folder,reduce_height,reduce_width)
+    imgs,labels = read_faces_level(faces,target_folders,label_1_folder,reduce_height,reduce_width,n_workers=n_workers,use_cache=use_cache)
 
     # To evaluate the threshold of the dark pixels
     # dark_pixel_curve(images)
     # Eliminate the images and labels whose number of dark pixels are above the threshold
-    # The threshold is determined based on the dark_pixel_curve() function above
-    imgs,labels,remove_count = remove_dark_img(imgs,labels,180) 
+    # The threshold is determined based on the dark_pixel_curve() function above, with 24*21 images;
+    # the dark pixels are always counted at this size so the same images are removed at every resolution
+    if (reduce_height,reduce_width) == faces_dark_pixel_size:
+        imgs_dark = imgs
+    else:
+        imgs_dark,labels = read_faces_level(faces,target_folders,label_1_folder,faces_dark_pixel_size[0],faces_dark_pixel_size[1],n_workers=n_workers,use_cache=use_cache)
+    keep = count_dark_pixels(imgs_dark) <= dark_pixel_threshold
+    imgs,labels_vector = imgs[keep],labels[keep]
 
     # Visualization of images and labels
-    # plot_images(imgs,labels)
+    # plot_images(imgs,labels_vector)
 
     # Randomly select and show anomalous images
-    # show_anomaly_images(imgs,labels)
-    
-    # Convert the image dataset to a matrix
+    # show_anomaly_images(imgs,labels_vector)
 
+    # Convert the image dataset to a matrix
     # Find the dimension of one image
-    height, width = imgs[0].shape 
+    num_imgs, height, width = imgs.shape
     faces.img_height = height # Save the height
     faces.img_width = width # Save the width
-    img_size = height*width # The length of one image vector
-    num_imgs = len(imgs) # Total num of images
-    # Initialize the matrix to store the entire image list
-    # matrix size: m*n
-    imgs_matrix = np.zeros((num_imgs,img_size)) 
-    # Iterate through each image, convert it into an array, and add to the imgs_matrix as a column
-    for i in range(0,len(imgs)):
-        imgs_matrix[i,:] = imgs[i].reshape(img_size)
-    # Vectorize the labels list
-    labels_vector = np.hstack(labels) # Easier to get multiple items from a vector than from a list
-    # labels_vector.reshape(-1)
+    # matrix size: m*n, each row is one image; a view of the uint8 tensor
+    imgs_matrix = imgs.reshape(num_imgs,height*width)
 
     # Split the images and labels into the training and testing set
-    imgs_train,imgs_test,labels_train,labels_test = split_data_labels_training_testing(imgs_matrix,labels_vector)
+    ratio_train = 0.8
+    manifest_fname = split_manifest_fname(faces,ratio_train) if reuse_split else None
+    imgs_train,imgs_test,labels_train,labels_test = split_data_labels_training_testing(imgs_matrix,labels_vector,ratio_train,manifest_fname)
 
     return faces,imgs_train,imgs_test,labels_train,labels_test
 
-def read_synthetic_data(folder_path=''):
+def read_synthetic_data(folder_path='',reuse_split = False):
     """
     Automate the process to read and process the data in any of the synthetic folder
+    reuse_split: if True, the training/testing split is saved in the cache folder and reused between runs;
+    off by default, so repeated runs (e.g. Reports/evaluate_results.py) each draw a new split
     """
     # Read the faces as an instance of the AnomalyData Class
     synthetic = set_synthetic(folder_path)
-    # Set filenames
-    data_fname = 'data.npy'
-    labels_fname = 'labels.npy'
 
-    # Load
-    data = np.load(synthetic.data_path + data_fname)
-    labels = np.load(synthetic.data_path + labels_fname)
+    # Load: memory-mapped, so only the rows selected below are read from disk
+    store = None
+    if has_dataset_store(synthetic.store_path): # Use the dataset store if it has been built
+        store = open_dataset_store(synthetic.store_path)
+        if 'data_packed' in store: # Bit-packed rows written by generate_synthetic_store()
+            labels = store.labels_of('data_packed') # bool anomaly labels
+        else:
+            data = store['data'] # uint8 binary vectors
+            labels = store.labels_of('data') # bool anomaly labels
+    else:
+        # Set filenames
+        data_fname = 'data.npy'
+        labels_fname = 'labels.npy'
+        data = np.load(synthetic.data_path + data_fname, mmap_mode='r')
+        labels = np.load(synthetic.data_path + labels_fname, mmap_mode='r')
 
     # Split the data and labels into the training & testing groups
     # Split the images and labels
     ratio_train = 0.7 # No training set
-    train_ind, test_ind = split_training(labels,ratio_train)
+    manifest_fname = split_manifest_fname(synthetic,ratio_train) if reuse_split else None
+    split = get_split(labels,ratio_train,manifest_fname)
 
-    data_train = data[train_ind] 
-    data_test = data[test_ind]
-    labels_train = labels[train_ind]
-    labels_test = labels[test_ind]
+    if store is not None and 'data_packed' in store:
+        data_train = read_binary_rows(store, split.train_ind) # Unpack only the selected rows
+        data_test = read_binary_rows(store, split.test_ind)
+    else:
+        data_train = split.train(data)
+        data_test = split.test(data)
+    labels_train = split.train(labels)
+    labels_test = split.test(labels)
 
     return synthetic, data_train, data_test, labels_train, labels_test
 
+def build_synthetic_store(folder_path=''):
+    """
+    Convert the data.npy and labels.npy files of a synthetic folder into a dataset store:
+    the binary data is stored as uint8 and the labels as bool
+    """
+    synthetic = set_synthetic(folder_path)
+    npy_paths = {'data': synthetic.data_path + 'data.npy', 'labels': synthetic.data_path + 'labels.npy'}
+    return convert_npy_to_store(synthetic.store_path, npy_paths, {'data': 'labels'})
+
 
 ## Functions of Detection Models
 def detection_with_pca_reconstruction_error(AnomalyData,data_train,data_test,labels_train,labels_test,to_print = False):
@@ -205,23 +289,120 @@ def detection_with_pca_reconstruction_error(AnomalyData,data_train,data_test,lab
     if to_print:
         evaludate_pc(data_train,labels_train) # Evaluate the % variance achieved at different #PC
 
-    # Compute PCA with training dataset, and reconstruct the training dataset
-    data_train_pca,pca_matrix,component_mean = pca_all_processes(data_train,labels_train,AnomalyData.n_components,plot_eigenfaces_bool=to_print,plot_comparison_bool=to_print,height=AnomalyData.img_height,width=AnomalyData.img_width)
-    # Reconstruct the test set
-    data_test_pca = reconstruct_with_pca(data_test,component_mean,pca_matrix,AnomalyData.n_components)
+    unique_train = None
+    if AnomalyData.chunk_size is not None: # Out-of-core: fit the PCA chunk by chunk
+        pca_matrix,component_mean,accumulator = fit_pca_streaming(data_train,labels_train,AnomalyData.chunk_size,AnomalyData.n_components,AnomalyData.pca_solver,dtype=AnomalyData.dtype)
+        eigen_value = component_variance(accumulator.covariance(),pca_matrix)
+    else:
+        if AnomalyData.dedup: # Fit on the unique rows only, weighted by their multiplicities
+            unique_train = find_unique_rows(data_train,labels_train)
+            data_fit, labels_fit, weights_fit = unique_train.patterns, unique_train.pattern_labels(), unique_train.normal_counts
+        else:
+            data_fit, labels_fit, weights_fit = data_train, labels_train, None
+        # Compute PCA with training dataset
+        fit, data_fingerprint = get_pca_fit(data_fit,labels_fit,AnomalyData.n_components,weights_fit,AnomalyData.pca_solver,AnomalyData.pca_cache,AnomalyData.dtype)
+        pca_matrix, component_mean, eigen_value = fit.pca_matrix, fit.component_mean, fit.eigen_value
+        if to_print: # The reconstruction is only needed for the plots
+            if AnomalyData.img_height*AnomalyData.img_width != 0: # Plot the eigenfaces only if the data is of the type image
+                print("Below is the eigenfaces from the PCA Matrix")
+                plot_eigenfaces(pca_matrix[:,:AnomalyData.n_components],AnomalyData.img_height,AnomalyData.img_width)
+                print()
+            data_fit_pca = reconstruct_with_pca(data_fit, component_mean, pca_matrix, AnomalyData.n_components)
+            print("Below is a comparison between the original and the reconstructed data")
+            plot_compare_after_reconst(data_fit_pca,data_fit,AnomalyData.img_height,AnomalyData.img_width)
+            print()
 
     if to_print: 
+        data_train_pca = reconstruct_with_pca(data_train, component_mean, pca_matrix, AnomalyData.n_components) # Reconstruct with PCA
         compare_var(data_train, data_train_pca,to_print = to_print) # Find the % variance achieved at the current #PC
 
+    def reconstruction_error(data): # Euclidean distance between the data and its reconstruction, without decoding the data
+        return pca_reconstruction_error(data,component_mean,pca_matrix,AnomalyData.n_components)
+    dist_train, dist_test = score_rows(AnomalyData,reconstruction_error,data_train,data_test,unique_train = unique_train)
+
     # Anomaly Detection with Reconstruction Error
-    if to_print: # Print result
-        train_test_with_reconstruction_error(data_train, data_train_pca, data_test, data_test_pca, labels_train, labels_test,AnomalyData.k,to_print = to_print)
-    else:  # Return results in numeric values
-        results = train_test_with_reconstruction_error(data_train, data_train_pca, data_test, data_test_pca, labels_train, labels_test,AnomalyData.k,to_print = to_print)
+    results = train_test_with_distance(dist_train, dist_test, labels_train, labels_test,AnomalyData.k,to_print = to_print,folds = AnomalyData.threshold_folds,n_workers = AnomalyData.cv_workers) # None if the results are printed
+    if AnomalyData.save_pca_model: # Save the fitted model, so it can score new data without refitting (see load_pca_model())
+        threshold = None if results is None else results.threshold
+        save_pca_model(pca_model_path(AnomalyData,'PCA Reconstruction'),PCAModel(pca_matrix,component_mean,eigen_value,AnomalyData.n_components,threshold=threshold,detect_model='PCA Reconstruction'))
+    if not to_print:  # Return results in numeric values
         results.data_name = AnomalyData.data_name # Record the data name
         results.detect_model = 'PCA Reconstruction' # Record the detection model name
         return results
 
+def sweep_pca_reconstruction_error(AnomalyData,data_train,data_test,labels_train,labels_test,n_components_list = None,to_print = False):
+    """
+    Run the PCA Reconstruction Error detection for many numbers of components at once, to choose AnomalyData.n_components:
+    the PCA is fitted once, and the reconstruction errors for every number of components come from one projection
+    (see pca_reconstruction_error_sweep()); the threshold is then trained and tested for each number of components.
+    - n_components_list: the numbers of components to evaluate; by default, about 50 values from 1 to n
+    Returns the list of numbers of components, the list of results, and the reconstruction errors of the training and
+    testing rows (matrices of size m * len(n_components_list), one column per number of components)
+    """
+    n_features = data_train.shape[1]
+    if n_components_list is None:
+        step_size = max(int(n_features/50),1)
+        n_components_list = list(range(1,n_features+1,step_size))
+
+    # Fit all the components once: the errors are computed from the whole basis
+    if AnomalyData.chunk_size is not None:
+        pca_matrix,component_mean,accumulator = fit_pca_streaming(data_train,labels_train,AnomalyData.chunk_size,dtype=AnomalyData.dtype)
+    else:
+        pca_matrix,component_mean = compute_pca_matrix(data_train[labels_train == 0],dtype=AnomalyData.dtype)
+    dist_train = pca_reconstruction_error_sweep(data_train,component_mean,pca_matrix,n_components_list)
+    dist_test = pca_reconstruction_error_sweep(data_test,component_mean,pca_matrix,n_components_list)
+
+    results_list = []
+    for i, n_components in enumerate(n_components_list):
+        results = train_test_with_distance(dist_train[:,i], dist_test[:,i], labels_train, labels_test,AnomalyData.k,to_print = False,folds = AnomalyData.threshold_folds,n_workers = AnomalyData.cv_workers)
+        results.data_name = AnomalyData.data_name # Record the data name
+        results.detect_model = 'PCA Reconstruction' # Record the detection model name
+        results_list.append(results)
+
+    if to_print:
+        print("Testing Results for each number of components:")
+        for n_components, results in zip(n_components_list, results_list):
+            print("#PC = {0}: F-score {1:.1f}%, R-Precision {2:.1f}%, Precision@{3} {4:.1f}%".format(n_components, results.F*100, results.RPrec*100, results.k, results.PrecK*100))
+        plt.plot(n_components_list,[results.RPrec for results in results_list],label = 'R-Precision')
+        plt.plot(n_components_list,[results.PrecK for results in results_list],label = 'Precision@k')
+        plt.xlabel('# Components Retained after encoding')
+        plt.ylabel('Testing Score')
+        plt.title('Reconstruction Error Detection with different number of PC')
+        plt.legend()
+        plt.show()
+    return n_components_list, results_list, dist_train, dist_test
+
+def sweep_mnist_anomaly_digits(detect_funcs,anomaly_digits = range(10),img_size = 32,chunk_size = 2**14):
+    """
+    Run the PCA detectors with every digit in anomaly_digits as the anomaly, with one pass over the training images:
+    the counts, means and scatter matrices of each digit are accumulated once (see class_statistics()), and the PCA of
+    "all the digits except d" comes from merging the statistics of the other digits, so every digit only costs one
+    eigendecomposition instead of a covariance pass over the images. The gaussian of the PCA Gaussian detector comes
+    from the same statistics (see leave_one_class_out_gaussian()).
+    The fits are put in the PCA cache, where the detectors find them instead of refitting (AnomalyData.pca_cache must be on);
+    the training images are still encoded once per digit, to score them.
+    - detect_funcs: the PCA detection functions to run, e.g. [detection_with_pca_reconstruction_error, detection_with_pca_gaussian]
+    Returns a list of Results, one per digit and detection function
+    """
+    mnist = set_mnist()
+    imgs_train, imgs_test, digits_train, digits_test = read_mnist_images(mnist,img_size)
+    class_stats = class_statistics(imgs_train,digits_train,chunk_size)
+    data_fingerprint = array_fingerprint(imgs_train)
+
+    results_list = []
+    for anomaly_digit in anomaly_digits:
+        labels_train = label_anomaly(digits_train, anomaly_digit)
+        labels_test = label_anomaly(digits_test, anomaly_digit)
+        pca_matrix, component_mean, eigen_value = leave_one_class_out_pca(class_stats,anomaly_digit,mnist.n_components,mnist.pca_solver,mnist.dtype)
+        key = pca_fit_key(data_fingerprint,labels_train,None,mnist.n_components,mnist.pca_solver,mnist.dtype)
+        gaussian = leave_one_class_out_gaussian(class_stats,pca_matrix,component_mean,mnist.n_components)
+        pca_fit_cache.put(key,PCAFit(pca_matrix,component_mean,mnist.n_components,eigen_value,gaussian))
+        for detect_func in detect_funcs:
+            results = detect_func(mnist,imgs_train,imgs_test,labels_train,labels_test)
+            results.data_name = mnist.data_name + ' (anomaly digit ' + str(anomaly_digit) + ')'
+            results_list.append(results)
+    return results_list
+
 def detection_with_pca_gaussian(AnomalyData,data_train, data_test,labels_train,labels_test,to_print = False):
     """
     Function to apply anomaly detection with PCA and Gaussian
@@ -234,20 +415,57 @@ def detection_with_pca_gaussian(AnomalyData,data_train, data_test,labels_train,l
 
     if to_print:
         evaludate_pc(data_train,labels_train) # Evaluate the % variance achieved at different #PC
-    # Compute PCA with training dataset and encode the training dataset
-    data_train_encoded,pca_matrix, component_mean = pca_all_processes(data_train,labels_train,AnomalyData.n_components,plot_eigenfaces_bool = to_print,decode = False,height=AnomalyData.img_height,width=AnomalyData.img_width)
-    # Encode the test set
-    data_test_encoded = encode_pca(data_test, component_mean,pca_matrix,AnomalyData.n_components)
+    unique_train = unique_test = None
+    if AnomalyData.chunk_size is not None: # Out-of-core: fit the PCA chunk by chunk; the data is encoded chunk by chunk below
+        pca_matrix,component_mean,accumulator = fit_pca_streaming(data_train,labels_train,AnomalyData.chunk_size,AnomalyData.n_components,AnomalyData.pca_solver,dtype=AnomalyData.dtype)
+        eigen_value = component_variance(accumulator.covariance(),pca_matrix)
+    else:
+        if AnomalyData.dedup: # Fit and encode the unique rows only, weighted by their multiplicities
+            unique_train = find_unique_rows(data_train,labels_train)
+            unique_test = find_unique_rows(data_test)
+            data_fit, labels_fit, weights_fit, data_score = unique_train.patterns, unique_train.pattern_labels(), unique_train.normal_counts, unique_test.patterns
+        else:
+            data_fit, labels_fit, weights_fit, data_score = data_train, labels_train, None, data_test
+        # Compute PCA with training dataset and encode the training dataset
+        # The fit and the encoded data are shared with the other PCA detector and earlier runs through the cache
+        fit, data_fingerprint = get_pca_fit(data_fit,labels_fit,AnomalyData.n_components,weights_fit,AnomalyData.pca_solver,AnomalyData.pca_cache,AnomalyData.dtype)
+        pca_matrix, component_mean, eigen_value = fit.pca_matrix, fit.component_mean, fit.eigen_value
+        if (to_print and AnomalyData.img_height*AnomalyData.img_width != 0): # Plot the eigenfaces only if the data is of the type image
+            print("Below is the eigenfaces from the PCA Matrix")
+            plot_eigenfaces(pca_matrix[:,:AnomalyData.n_components],AnomalyData.img_height,AnomalyData.img_width)
+            print()
+        data_train_encoded = pca_fit_cache.encode(fit, data_fit, data_fingerprint, AnomalyData.pca_cache)
+        # Encode the test set
+        data_test_encoded = pca_fit_cache.encode(fit, data_score, use_cache = AnomalyData.pca_cache)
 
     if to_print: 
         data_train_pca = reconstruct_with_pca(data_train, component_mean, pca_matrix, AnomalyData.n_components) # Reconstruct with PCA
         compare_var(data_train, data_train_pca,to_print = to_print) # FInd the % variance achieved at the current #PC
 
     # Anomaly Detection with the Gaussian Model
-    if to_print: # Print result
-        train_test_with_gaussian(data_train_encoded, data_test_encoded, labels_train, labels_test,AnomalyData.k,to_print=to_print)
-    else:  # Return results in numeric values
-        results = train_test_with_gaussian(data_train_encoded, data_test_encoded, labels_train, labels_test,AnomalyData.k,to_print=to_print)
+    def encode(data):
+        return encode_pca(data,component_mean,pca_matrix,AnomalyData.n_components)
+    if AnomalyData.chunk_size is not None:
+        dist = fit_gaussian_streaming(data_train,encode,AnomalyData.chunk_size)
+    elif fit.gaussian is not None and unique_train is None: # Known from the statistics of the fit (e.g. sweep_mnist_anomaly_digits())
+        dist = fit.gaussian
+    else:
+        dist = fit_gaussian_model(data_train_encoded, labels_train, AnomalyData.k, to_print=to_print, unique_train=unique_train)
+    if AnomalyData.lookup_table or AnomalyData.chunk_size is not None: # Score with a lookup table, or chunk by chunk
+        def log_density(data): # Log-density of being normal
+            return dist.logpdf(encode(data))
+        p_train, p_test = score_rows(AnomalyData,log_density,data_train,data_test)
+    else: # Score the encoded data, as in train_test_with_gaussian()
+        p_train = dist.logpdf(data_train_encoded)   # Log-density of Being Normal
+        p_test = dist.logpdf(data_test_encoded)   # Log-density of Being Normal
+        if unique_train is not None: # Copy the log-density of each pattern to its rows
+            p_train = unique_train.expand(p_train)
+            p_test = unique_test.expand(p_test)
+    results = train_test_with_probability(p_train, p_test, labels_train, labels_test, AnomalyData.k, to_print = to_print) # None if the results are printed
+    if AnomalyData.save_pca_model: # Save the fitted model with its gaussian, so it can score new data without refitting (see load_pca_model())
+        threshold = None if results is None else results.threshold
+        save_pca_model(pca_model_path(AnomalyData,'PCA Guassian'),PCAModel(pca_matrix,component_mean,eigen_value,AnomalyData.n_components,dist.mean,dist.cov,threshold,'PCA Guassian'))
+    if not to_print:
         results.data_name = AnomalyData.data_name # Record the data name
         results.detect_model = 'PCA Guassian' # Record the detection model name
         return results
@@ -278,17 +496,20 @@ def detection_with_autoencoder_reconstruction_error(AnomalyData,data_train, data
         print("\n The output shape of the autoencoder model: ")
         print(autoencoder.output_shape)
     
-    # Reconstruct the training data with autoencoder
-    data_train_reconstructed,data_train = reconstruct_with_autoencoder(autoencoder,data_train,visual =to_print,height = AnomalyData.img_height, width = AnomalyData.img_width,image=AnomalyData.is_image_data)
+    # Print the reconstructed data
+    if to_print:
+        reconstruct_with_autoencoder(autoencoder,data_train,visual =to_print,height = AnomalyData.img_height, width = AnomalyData.img_width,image=AnomalyData.is_image_data)
 
-    # Reconstruct the testing data
-    data_test_reconstructed,data_test = reconstruct_with_autoencoder(autoencoder,data_test,visual =False,height = AnomalyData.img_height, width = AnomalyData.img_width,image=AnomalyData.is_image_data)
+    def reconstruction_error(data): # Euclidean distance between the (normalized) data and its reconstruction
+        data_reconstructed,data = reconstruct_with_autoencoder(autoencoder,data,image=AnomalyData.is_image_data)
+        return find_euclidean_distance(data_reconstructed,data)
+    dist_train, dist_test = score_rows(AnomalyData,reconstruction_error,data_train,data_test)
 
     # Anomaly Detection with Reconstruction Error
     if to_print: # Print result
-        train_test_with_reconstruction_error(data_train, data_train_reconstructed, data_test, data_test_reconstructed, labels_train, labels_test,AnomalyData.k,to_print = to_print)
+        train_test_with_distance(dist_train, dist_test, labels_train, labels_test,AnomalyData.k,to_print = to_print,folds = AnomalyData.threshold_folds,n_workers = AnomalyData.cv_workers)
     else:  # Return results in numeric values
-        results = train_test_with_reconstruction_error(data_train, data_train_reconstructed, data_test, data_test_reconstructed, labels_train, labels_test,AnomalyData.k,to_print = to_print)
+        results = train_test_with_distance(dist_train, dist_test, labels_train, labels_test,AnomalyData.k,to_print = to_print,folds = AnomalyData.threshold_folds,n_workers = AnomalyData.cv_workers)
         results.data_name = AnomalyData.data_name # Record the data name
         results.detect_model = 'Autoencoder Reconstruction' # Record the detection model name
         return results
@@ -302,18 +523,8 @@ def detection_with_autoencoder_gaussian(AnomalyData,data_train, data_test,labels
     """
     if to_print:
         print("Start the Anomaly Detection with Deep Autoencoder and Multivariate Gaussian Model: ")
-    # Generate and Compile an encoder
-    # Specify the model config
-    data_dimensions=data_train.shape[1] # No.dimensions in the data
-    encoder_hidden_layers = AnomalyData.encoder_hidden_layers
-    decoder_hidden_layers = AnomalyData.decoder_hidden_layers
-    # Extract the saved autoencoder model
-    autoencoder, encoder = compile_autoencoder(data_dimensions,encoder_hidden_layers, decoder_hidden_layers) 
-    autoencoder = load_model(AnomalyData.model_path) # Load the saved model
-    # Extract the encoder model from the autoencoder model
-    encoder_n_layers = len(encoder_hidden_layers) # Get the number of layers in the encoder
-    weights_encoder = autoencoder.get_weights()[0:encoder_n_layers+1] # The first half of the autoencoder model is an encoder model
-    encoder.set_weights(weights_encoder) # Set weights
+    # Extract the saved autoencoder model and its encoder
+    autoencoder, encoder = load_encoder(AnomalyData)
 
     # Print the summary  of the encoder model
     if to_print:
@@ -325,30 +536,42 @@ def detection_with_autoencoder_gaussian(AnomalyData,data_train, data_test,labels
     # Print the reconstructed image
     if to_print:
         data_train_reconstructed,data_train = reconstruct_with_autoencoder(autoencoder,data_train,visual =to_print,height = AnomalyData.img_height, width = AnomalyData.img_width,image=AnomalyData.is_image_data)
-    # Encode the data in the training and the testing set
-    data_train_encoded = encode_data(encoder, data_train)
-    data_test_encoded = encode_data(encoder, data_test)
-
-    # Anomaly Detection with the Gaussian Model: need to whiten the covariance
-    if to_print: # Print result
-        train_test_with_gaussian(data_train_encoded, data_test_encoded, labels_train, labels_test,AnomalyData.k,whitened = True, plot_comparison = to_print, to_print=to_print)
+    unique_train = unique_test = None
+    if AnomalyData.dedup: # Encode the unique rows only
+        unique_train = find_unique_rows(data_train,labels_train)
+        unique_test = find_unique_rows(data_test)
+        data_train_encoded = encode_data(encoder, unique_train.patterns)
+        data_test_encoded = encode_data(encoder, unique_test.patterns)
+    else:
+        # Encode the data in the training and the testing set
+        data_train_encoded = encode_data(encoder, data_train)
+        data_test_encoded = encode_data(encoder, data_test)
+
+    # Anomaly Detection with the Gaussian Model: need to whiten (or shrink) the covariance
+    shrinkage = None if AnomalyData.covariance_estimator == 'cv' else AnomalyData.covariance_estimator
+    if AnomalyData.lookup_table: # Score every possible binary row once, then look the rows up
+        dist = fit_gaussian_model(data_train_encoded, labels_train, AnomalyData.k, whitened = True, plot_comparison = to_print, to_print=to_print, unique_train=unique_train, shrinkage=shrinkage, n_workers=AnomalyData.cv_workers)
+        def log_density(data): # Log-density of being normal
+            return dist.logpdf(encode_data(encoder, data))
+        p_train, p_test = score_rows(AnomalyData,log_density,data_train,data_test)
+        results = train_test_with_probability(p_train, p_test, labels_train, labels_test, AnomalyData.k, to_print = to_print)
+    elif to_print: # Print result
+        train_test_with_gaussian(data_train_encoded, data_test_encoded, labels_train, labels_test,AnomalyData.k,whitened = True, plot_comparison = to_print, to_print=to_print,unique_train=unique_train,unique_test=unique_test,shrinkage=shrinkage,n_workers=AnomalyData.cv_workers)
     else:  # Return results in numeric values
-        results = train_test_with_gaussian(data_train_encoded, data_test_encoded, labels_train, labels_test,AnomalyData.k,whitened = True, plot_comparison = to_print, to_print=to_print)
+        results = train_test_with_gaussian(data_train_encoded, data_test_encoded, labels_train, labels_test,AnomalyData.k,whitened = True, plot_comparison = to_print, to_print=to_print,unique_train=unique_train,unique_test=unique_test,shrinkage=shrinkage,n_workers=AnomalyData.cv_workers)
+    if not to_print:
         results.data_name = AnomalyData.data_name # Record the data name
         results.detect_model = 'Autoencoder Gaussian' # Record the detection model name
         return results
 
 ## Support Functions for Yale Faces Data
-def read_faces_images(data_path,target_folders,label_1_folder,reduce_height = 24,reduce_width = 21):
+def list_faces_images(data_path,target_folders,label_1_folder):
     """
-    This function reads in all images inside the specified folders, and label the images based on label_1_folder
-    data_path: the path of the folder where all the image folders reside in
-    target_folders: the target_folders to be read from
-    label_1_folder: images in the specified folders will be labeled with 1
+    This function lists all images inside the specified folders, and label the images based on label_1_folder
+    The "Ambient" images are excluded because they are profile pictures
     """
-    # label_1_folder = [9,21]
-    imgs_folder_paths = glob.glob(data_path + "*")
-    images = [] # Initialize a list to record images
+    imgs_folder_paths = sorted(glob.glob(data_path + "*"))
+    img_paths = [] # Initialize a list to record the image paths
     labels = [] # Initialize a list to record labels
     for folder_path in imgs_folder_paths:
         index = int(folder_path[-2:]) # Get the index embeded in the folder path
@@ -358,38 +581,133 @@ def read_faces_images(data_path,target_folders,label_1_folder,reduce_height = 24
                 label =1
             else:
                 label = 0
-
-            # Read in images and corresponding labels
-            img_paths = glob.glob(folder_path + "/*.pgm")
-            for img_path in img_paths: 
-                if img_path.find("Ambient")>0:
-                    img_paths.remove(img_path) # We do not want the "Ambient" image because it is a profile picture
-                else:
-                    # img = plt.imread(img_path) # Used to read image without resizing
-                    img_raw = Image.open(img_path) # Used when we need to resize the image (downsize in this case)
-                    img_reduce = img_raw.resize((reduce_width, reduce_height), Image.BILINEAR) # Resize the image
-                    img = np.array(img_reduce) # This step is necessary if we use Image.open()
-                    images.append(img)
+            for img_path in sorted(glob.glob(folder_path + "/*.pgm")):
+                if img_path.find("Ambient")<0:
+                    img_paths.append(img_path)
                     labels.append(label)
+    return img_paths,labels
+
+def read_face_image(img_path,reduce_height = None,reduce_width = None):
+    """
+    This function reads one face image, at full size unless a reduced size is given
+    """
+    # img = plt.imread(img_path) # Used to read image without resizing
+    img_raw = Image.open(img_path)
+    if reduce_height is not None:
+        img_raw = img_raw.resize((reduce_width, reduce_height), Image.BILINEAR) # Resize the image
+    img = np.array(img_raw) # This step is necessary if we use Image.open()
+    return img
+
+def read_faces_images(data_path,target_folders,label_1_folder,reduce_height = None,reduce_width = None,n_workers = 1):
+    """
+    This function reads in all images inside the specified folders, and label the images based on label_1_folder
+    data_path: the path of the folder where all the image folders reside in
+    target_folders: the target_folders to be read from
+    label_1_folder: images in the specified folders will be labeled with 1
+    reduce_height, reduce_width: resize every image while decoding; by default the images are kept at full size
+    (use resize_batch() to resize the whole stack at once instead)
+    n_workers: number of threads to decode the images (PIL releases the GIL while decoding and resizing)
+    """
+    # label_1_folder = [9,21]
+    img_paths,labels = list_faces_images(data_path,target_folders,label_1_folder)
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            images = list(executor.map(lambda img_path: read_face_image(img_path,reduce_height,reduce_width), img_paths))
+    else:
+        images = [read_face_image(img_path,reduce_height,reduce_width) for img_path in img_paths]
     return images,labels
 
+# Resolution pyramid of the faces: the sizes (height, width) kept in the cache, None is the full size
+faces_pyramid_levels = [(24,21),(48,42),None]
+faces_dark_pixel_size = (24,21) # The size at which the dark pixels are counted
+
+def faces_cache_fname(faces,target_folders,label_1_folder,level = None):
+    """
+    This function returns the file name of one level of the faces resolution pyramid in the cache.
+    The name is a hash of the image folders and of the path, size and mtime of every image file,
+    so the cache is rebuilt whenever an image changes; the level ('full' or height x width) is appended.
+    """
+    img_paths,labels = list_faces_images(faces.data_path,target_folders,label_1_folder)
+    files = [(img_path, os.stat(img_path).st_mtime_ns, os.stat(img_path).st_size) for img_path in img_paths]
+    key = {
+        'target_folders': list(target_folders),
+        'label_1_folder': list(label_1_folder),
+        'files': files,
+    }
+    key_hash = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    level_name = 'full' if level is None else '{0}x{1}'.format(level[0],level[1])
+    return faces.cache_path + 'faces_' + key_hash + '_' + level_name + '.npz'
+
+def save_faces_cache(cache_fname,imgs,labels):
+    """
+    Save the uint8 images and labels; written to a temporary file first so a partial cache is never read
+    """
+    os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+    tmp_fname = cache_fname[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmp_fname, imgs=imgs, labels=labels)
+    os.replace(tmp_fname, cache_fname)
+
+def read_faces_level(faces,target_folders,label_1_folder,height = None,width = None,n_workers = 1,use_cache = True):
+    """
+    Read all the faces at one size, as a stacked uint8 tensor (num_imgs * height * width) and a label vector.
+    The images are decoded only once, at full size; every other size is resized from the full-size stack
+    with resize_batch() (area average), and each size is kept in the cache, so changing the size costs no decoding.
+    """
+    level = None if height is None else (height,width)
+    cache_fname = faces_cache_fname(faces,target_folders,label_1_folder,level)
+    if use_cache and os.path.isfile(cache_fname):
+        with np.load(cache_fname) as cache:
+            return cache['imgs'], cache['labels']
+
+    if level is None:
+        # Decode the full-size images and stack them into one uint8 tensor
+        imgs,labels = read_faces_images(faces.data_path,target_folders,label_1_folder,n_workers=n_workers)
+        imgs = np.stack(imgs).astype(np.uint8)
+        labels = np.hstack(labels) # Easier to get multiple items from a vector than from a list
+    else:
+        imgs_full,labels = read_faces_level(faces,target_folders,label_1_folder,n_workers=n_workers,use_cache=use_cache)
+        imgs = resize_batch(imgs_full,height,width)
+
+    if use_cache:
+        save_faces_cache(cache_fname,imgs,labels)
+    return imgs,labels
+
+def build_faces_pyramid(levels = faces_pyramid_levels,n_workers = cpu_count()):
+    """
+    Fill the cache with every level of the faces resolution pyramid
+    """
+    faces = set_faces()
+    label_1_folder = [9,21]
+    target_folders = range(1,29)
+    for level in levels:
+        height, width = (None,None) if level is None else level
+        read_faces_level(faces,target_folders,label_1_folder,height,width,n_workers=n_workers)
+
+def count_dark_pixels(images,light_threshold = 20):
+    """
+    Count the dark pixels (below light_threshold) of every image in one vectorized pass
+    images: a stacked array of images (num_imgs * height * width) or a list of images of the same size
+    """
+    images = np.asarray(images)
+    dark_counts = np.count_nonzero(images.reshape(len(images),-1) < light_threshold, axis = 1)
+    return dark_counts
+
 def dark_pixel_curve(images,light_threshold = 20):
     """
     Images are taken at different lighting conditions; thus some of the photos are dark. In order to avoid 
     the impact of the bad lighting conditions, we need to remove photos with large number of dark pixels. 
     This curve shows us the number of images to be removed at different thresholds (total number of pixels 
     that are below 20 in one image). It can help us select an appropriate threshold. 
+    The dark pixels are counted once per image; the whole curve then comes from one cumulative histogram.
     """
     height, width = images[0].shape # Get the dimension of one image
-    images_num = len(images)
+    dark_counts = count_dark_pixels(images,light_threshold)
     thresh_list = range(100,height*width,100) # Threshold levels to be tested: from 100 to the total pixels
-    remove_list = []
-    for dark_pixel_threshold in thresh_list:
-        remove_count = 0
-        for i in range(0,images_num):
-            if sum(sum(images[i] < light_threshold)) > dark_pixel_threshold:
-                remove_count = remove_count + 1
-        remove_list.append(remove_count)
+    # Number of images with exactly c dark pixels, for c = 0 ... height*width
+    dark_hist = np.bincount(dark_counts, minlength = height*width+1)
+    # Number of images with more than c dark pixels: the images removed at the threshold c
+    remove_curve = len(dark_counts) - np.cumsum(dark_hist)
+    remove_list = remove_curve[list(thresh_list)]
     
     plt.plot(thresh_list,remove_list)
     plt.xlabel("Number of dark pixels in an image")
@@ -399,16 +717,12 @@ def dark_pixel_curve(images,light_threshold = 20):
 def remove_dark_img(imgs,labels,dark_pixel_threshold,light_threshold = 20):
     """
     This function remove images that have more dark pixels (<20) than our threshold
+    imgs: a stacked array of images (num_imgs * height * width); labels: a vector of the same length
     """
-    remove_count = 0
-    imgs_num = len(imgs)
-    for i in range(imgs_num-1,0-1,-1):
-        if sum(sum(imgs[i] < light_threshold)) > dark_pixel_threshold:
-            del imgs[i]
-            del labels[i]
-            remove_count = remove_count + 1
+    keep = count_dark_pixels(imgs,light_threshold) <= dark_pixel_threshold # Boolean mask of the images to keep
+    remove_count = int(np.sum(~keep))
     # print (remove_count,' images are above our threshold and thus removed from the list')
-    return imgs,labels,remove_count
+    return np.asarray(imgs)[keep],np.asarray(labels)[keep],remove_count
 
 ## Support Function for Data Processing
 def perm_and_split(m,ratio = 0.8):
@@ -417,7 +731,7 @@ def perm_and_split(m,ratio = 0.8):
     """
     ind = np.random.permutation(m) # Permutate to generate random indice within m
     size1 = int(m*ratio)
-    group1 = ind[:size1-1]
+    group1 = ind[:size1]
     group2 = ind[size1:]
     return group1, group2
 
@@ -427,29 +741,23 @@ def split_training(labels,ratio = 0.8):
     Its output is the indice of images to be assigned to the Training/Validation Set. 
     The input "labels" is a hvector
     The ratio is a number between [0,1] that represents the percentage of images to be assigned to the training set
+    Both sets contain anomalies as long as there are at least two of them (see stratified_split())
     """
-    m = len(labels)
-    training_size = int(m*ratio)
-    while 1:
-        ind = np.random.permutation(m) # Permutate to generate random indice within m
-        train_ind = ind[:training_size-1]
-        test_ind = ind[training_size:]
-        # if (sum(itemgetter(*train_ind)(labels)) > 0 and sum(itemgetter(*test_ind)(labels)) > 0):
-        if (sum(labels[train_ind]) > 0 and sum(labels[test_ind]) > 0):
-            break
-    return train_ind, test_ind
+    split = stratified_split(labels,ratio)
+    return split.train_ind, split.test_ind
 
-def split_data_labels_training_testing(data,labels,ratio_train = 0.8):
+def split_data_labels_training_testing(data,labels,ratio_train = 0.8,manifest_fname = None):
     """
     Function to split the data and labels into training and testing set
+    manifest_fname: if given, the split is saved to (and reused from) this file, see get_split()
     """
-    train_ind, test_ind = split_training(labels,ratio_train)
+    split = get_split(labels,ratio_train,manifest_fname)
 
-    data_train = data[train_ind]
-    data_test = data[test_ind]
+    data_train = split.train(data)
+    data_test = split.test(data)
 
-    labels_train = labels[train_ind]
-    labels_test = labels[test_ind]
+    labels_train = split.train(labels)
+    labels_test = split.test(labels)
 
     return data_train,data_test,labels_train,labels_test
 
@@ -480,6 +788,257 @@ def split_train_eval_test(labels,ratio_train = 0.8, ratio_val = 0):
     else:
         return train_ind, test_ind # No validation set
 
+## Support Functions for Index-based Splits
+class Split:
+    """
+    Class to record a split of a dataset into the training and testing set with index arrays only.
+    The rows are gathered from the data (e.g. a memory map) only when a subset is read.
+    Parameters:
+    - train_ind: sorted indices of the training rows
+    - test_ind: sorted indices of the testing rows
+    - n_rows: number of rows in the dataset
+    - ratio: share of each class assigned to the training set
+    """
+
+    def __init__(self,train_ind,test_ind,n_rows,ratio):
+        self.train_ind = train_ind # Vector of integers
+        self.test_ind = test_ind # Vector of integers
+        self.n_rows = n_rows # Integer
+        self.ratio = ratio # Double
+
+    def train(self,array,batch_size = 2**16):
+        """
+        Read the training rows of the array
+        """
+        return take_rows(array,self.train_ind,batch_size)
+
+    def test(self,array,batch_size = 2**16):
+        """
+        Read the testing rows of the array
+        """
+        return take_rows(array,self.test_ind,batch_size)
+
+    def iter_train(self,array,batch_size = 2**16):
+        """
+        Iterate over the training rows of the array batch by batch
+        """
+        return iter_rows(array,self.train_ind,batch_size)
+
+    def iter_test(self,array,batch_size = 2**16):
+        """
+        Iterate over the testing rows of the array batch by batch
+        """
+        return iter_rows(array,self.test_ind,batch_size)
+
+def index_dtype(n_rows):
+    """
+    The smallest integer type that holds every row index (keeps the saved manifests small)
+    """
+    return np.uint32 if n_rows < 2**32 else np.int64
+
+def is_contiguous(ind):
+    """
+    Check if sorted indices cover one contiguous range of rows
+    """
+    return len(ind) > 0 and int(ind[-1]) - int(ind[0]) + 1 == len(ind)
+
+def take_rows(array,ind,batch_size = 2**16):
+    """
+    Gather the rows of the array at the sorted indices ind
+    - a contiguous range is returned as a view, without copy
+    - otherwise the rows are gathered batch by batch into one preallocated array,
+      so a memory-mapped array is read in order and no temporary copy of the whole subset is made
+    """
+    if is_contiguous(ind):
+        return array[int(ind[0]):int(ind[-1])+1]
+    rows = np.empty((len(ind),) + array.shape[1:], dtype = array.dtype)
+    for start in range(0, len(ind), batch_size):
+        rows[start:start+batch_size] = array[ind[start:start+batch_size]]
+    return rows
+
+def iter_rows(array,ind,batch_size = 2**16):
+    """
+    Yield the rows of the array at the sorted indices ind, batch by batch
+    """
+    for start in range(0, len(ind), batch_size):
+        batch_ind = ind[start:start+batch_size]
+        if is_contiguous(batch_ind):
+            yield array[int(batch_ind[0]):int(batch_ind[-1])+1]
+        else:
+            yield array[batch_ind]
+
+def stratified_split(labels,ratio = 0.8):
+    """
+    Split the rows in a single O(n) pass: each class (anomaly/normal) is shuffled on its own,
+    and the given ratio of it is assigned to the training set.
+    If there are at least two anomalies, both sets get at least one of them.
+    """
+    labels = np.asarray(labels)
+    n_rows = len(labels)
+    is_anomaly = labels == 1
+    in_train = np.zeros(n_rows, dtype = bool)
+    for class_ind, is_anomaly_class in [(np.flatnonzero(is_anomaly),True), (np.flatnonzero(~is_anomaly),False)]:
+        n_train = int(len(class_ind)*ratio)
+        if is_anomaly_class and len(class_ind) >= 2:
+            n_train = min(max(n_train,1),len(class_ind)-1)
+        in_train[np.random.permutation(class_ind)[:n_train]] = True
+    # np.flatnonzero() returns sorted indices: the subsets are read from the data in order
+    train_ind = np.flatnonzero(in_train).astype(index_dtype(n_rows))
+    test_ind = np.flatnonzero(~in_train).astype(index_dtype(n_rows))
+    return Split(train_ind,test_ind,n_rows,ratio)
+
+def split_fingerprint(labels):
+    """
+    Fingerprint of the labels that a split was built for: a saved split is only reused for the same labels
+    """
+    labels = np.ascontiguousarray(labels)
+    return hashlib.sha1(labels.astype(bool).tobytes()).hexdigest()
+
+def save_split(manifest_fname,split,fingerprint):
+    """
+    Save the split as a small manifest: the index arrays and the parameters it was built with
+    """
+    os.makedirs(os.path.dirname(manifest_fname) or '.', exist_ok=True)
+    with open(manifest_fname, 'wb') as f: # np.savez() would add .npz to a name without it
+        np.savez(f, train_ind=split.train_ind, test_ind=split.test_ind, n_rows=split.n_rows, ratio=split.ratio, fingerprint=fingerprint)
+
+def load_split(manifest_fname):
+    """
+    Load a split saved by save_split(); returns the split and the fingerprint of its labels
+    """
+    with np.load(manifest_fname) as manifest:
+        split = Split(manifest['train_ind'],manifest['test_ind'],int(manifest['n_rows']),float(manifest['ratio']))
+        fingerprint = str(manifest['fingerprint'])
+    return split, fingerprint
+
+def get_split(labels,ratio = 0.8,manifest_fname = None):
+    """
+    Reuse the split saved in manifest_fname if it was built for the same labels and ratio;
+    otherwise build a new stratified split (and save it if manifest_fname is given)
+    """
+    if manifest_fname is None:
+        return stratified_split(labels,ratio)
+    fingerprint = split_fingerprint(labels)
+    if os.path.isfile(manifest_fname):
+        split, saved_fingerprint = load_split(manifest_fname)
+        if saved_fingerprint == fingerprint and split.ratio == ratio:
+            return split
+    split = stratified_split(labels,ratio)
+    save_split(manifest_fname,split,fingerprint)
+    return split
+
+def split_manifest_fname(AnomalyData,ratio):
+    """
+    File name of the saved split of a dataset
+    """
+    return AnomalyData.cache_path + 'split_' + str(ratio) + '.npz'
+
+
+## Support Functions for Duplicated Rows
+class UniqueRows:
+    """
+    Class to record the unique rows of a dataset and their multiplicities.
+    Low-dimensional binary data (e.g. the 16-dim synthetic datasets) holds at most 2^n distinct rows,
+    so models can be fitted and scored on the unique rows, weighted by their counts.
+    Parameters:
+    - patterns: the unique rows, a matrix of size u*n
+    - counts: number of rows equal to each pattern
+    - label_counts: number of rows of each pattern labeled as anomaly (None if no labels are given)
+    - normal_counts: number of rows of each pattern labeled as normal (None if no labels are given)
+    - inverse: for every original row, the index of its pattern, so that patterns[inverse] rebuilds the data
+    """
+
+    def __init__(self,patterns,counts,inverse,label_counts=None):
+        self.patterns = patterns # Matrix u*n
+        self.counts = counts # Vector of length u
+        self.inverse = inverse # Vector of length m
+        self.label_counts = label_counts # Vector of length u
+        self.normal_counts = None if label_counts is None else counts - label_counts # Vector of length u
+
+    def expand(self,values):
+        """
+        Copy per-pattern values (scores, encodings...) back to every original row
+        """
+        return values[self.inverse]
+
+    def pattern_labels(self):
+        """
+        Label of each pattern for fitting on normal data: 0 if at least one row of the pattern is normal, 1 otherwise
+        """
+        return (self.normal_counts == 0)*1
+
+def find_unique_rows(data,labels=None):
+    """
+    Collapse the rows of the data into (unique pattern, count, label count)
+    Binary rows are packed into one integer per row first, which makes the search a 1-D np.unique
+    """
+    data = np.asarray(data)
+    if data.shape[1] <= 64 and np.all((data == 0) | (data == 1)):
+        codes = pack_binary_rows(data)
+        codes_unique, index, inverse, counts = np.unique(codes, return_index=True, return_inverse=True, return_counts=True)
+        patterns = data[index]
+    else:
+        patterns, inverse, counts = np.unique(data, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    label_counts = None
+    if labels is not None:
+        label_counts = np.bincount(inverse, weights=np.asarray(labels) == 1, minlength=len(patterns)).astype(np.int64)
+    return UniqueRows(patterns,counts,inverse,label_counts)
+
+
+## Support Functions for Score Lookup Tables
+max_table_dimensions = 24 # Largest binary input for which a table of all the 2^n scores is built
+
+def is_binary_data(data):
+    """
+    Check if every value of the data is 0 or 1
+    """
+    return bool(np.all((data == 0) | (data == 1)))
+
+def build_score_table(score_func,n_dimensions,chunk_size = 2**16):
+    """
+    Score every possible binary row of n_dimensions once: table[code] is the score of the row packed into code
+    (see pack_binary_rows(), the first dimension is the most significant bit)
+    - score_func: a function that maps a matrix of rows (m*n) to a vector of m scores
+    """
+    if n_dimensions > max_table_dimensions:
+        raise ValueError('A score table of 2^' + str(n_dimensions) + ' rows is too large')
+    n_patterns = 2**n_dimensions
+    table = np.empty(n_patterns)
+    codes = np.arange(n_patterns, dtype = packed_dtype(n_dimensions))
+    for start in range(0, n_patterns, chunk_size):
+        patterns = unpack_binary_rows(codes[start:start+chunk_size], n_dimensions, dtype = np.float64)
+        table[start:start+chunk_size] = score_func(patterns)
+    return table
+
+def lookup_scores(table,data):
+    """
+    Score binary rows (m*n) with a table built by build_score_table(): a single gather over the packed rows
+    """
+    return table[pack_binary_rows(data)]
+
+def score_rows(AnomalyData,score_func,data_train,data_test,unique_train = None,unique_test = None):
+    """
+    Score the training and testing rows with a fitted model.
+    - AnomalyData.lookup_table: the score of every possible binary row is computed once, and the rows are looked up
+      (the table depends on the fitted model, so it is rebuilt for every fit and kept in memory only)
+    - AnomalyData.dedup: the unique rows are scored, and the scores are copied to their duplicates
+    - otherwise: every row goes through score_func, AnomalyData.chunk_size rows at a time
+    """
+    if AnomalyData.lookup_table:
+        if not (is_binary_data(data_train) and is_binary_data(data_test)):
+            raise ValueError('Score lookup tables need binary data')
+        table = build_score_table(score_func,data_train.shape[1])
+        return lookup_scores(table,data_train), lookup_scores(table,data_test)
+    if AnomalyData.dedup:
+        if unique_train is None:
+            unique_train = find_unique_rows(data_train)
+        if unique_test is None:
+            unique_test = find_unique_rows(data_test)
+        return unique_train.expand(score_func(unique_train.patterns)), unique_test.expand(score_func(unique_test.patterns))
+    return score_in_chunks(score_func,data_train,AnomalyData.chunk_size), score_in_chunks(score_func,data_test,AnomalyData.chunk_size)
+
+
 ## Support Functions for Reconstruction Error Methods
 def find_euclidean_distance(matrix1,matrix2):
     """
@@ -507,8 +1066,9 @@ def select_threshold(val, labels,anomaly_at_top=True,k=10, to_print = False):
         coef = 1
 
     # Initialize the Metrics: only the selected will be used in optimization
-    best_epsilon = 0
-    best_target = 0 # A recorder of the best value of the target variable -- assume the larger, the better
+    # If no threshold detects an anomaly, fall back to a threshold that flags nothing: log-densities are mostly negative,
+    # so 0 would flag almost every row when the anomaly is at the tail
+    best_epsilon = 0 if anomaly_at_top else -np.inf
 
     # Sort the edistance and yval based on pval from high to low (in order to measure the Precision at K)
     rank = np.argsort(coef*val) # Rank the data: Sort from the Largest to the Smallest if the anomaly is at the top; reverse if not
@@ -519,18 +1079,14 @@ def select_threshold(val, labels,anomaly_at_top=True,k=10, to_print = False):
     # Step Size
     step = (val_ranked.max() - val_ranked.min()) / 100
 
-    for epsilon in np.arange(val_ranked.min(), val_ranked.max(), step):
-        # When the anomaly is at the top, if the value is larger than the threshold, it will be identified as anomlay (use -1 to reverse '<' sign)
-        # When the anomaly is at the tail, if the value is smaller than the threshold, it will be identified as anomaly
-        preds = coef*val_ranked < coef*epsilon 
-
-        results = eval_prediction(preds,labels_ranked,k)
-        target = results.F # Set the F score as the target measurement
+    # When the anomaly is at the top, if the value is larger than the threshold, it will be identified as anomlay
+    # When the anomaly is at the tail, if the value is smaller than the threshold, it will be identified as anomaly
+    epsilons = np.arange(val_ranked.min(), val_ranked.max(), step)
+    targets = threshold_f_scores(val,labels,epsilons,anomaly_at_top) # Set the F score as the target measurement
 
-        # Optimize to find the best target value -- assuming the larger, the better
-        if target > best_target:
-            best_target = target
-            best_epsilon = epsilon # Record the epsilon at the best performance so far
+    # Optimize to find the best target value -- assuming the larger, the better (the first one if there are ties)
+    if len(targets) > 0 and targets.max() > 0:
+        best_epsilon = epsilons[int(np.argmax(targets))]
 
     # Get the best measurement with the best threshold
     if to_print: # Print out the result
@@ -538,11 +1094,61 @@ def select_threshold(val, labels,anomaly_at_top=True,k=10, to_print = False):
         eval_prediction(best_preds, labels_ranked, k,to_print = to_print) # Print out the result
     return best_epsilon
 
-def select_threshold_distance(edistance, labels,k=10, to_print = False):  
+def threshold_f_scores(val,labels,epsilons,anomaly_at_top = True):
+    """
+    F score of eval_prediction() for every threshold in epsilons at once: the values are sorted once, and the
+    number of (true) positives of each threshold comes from a binary search and a cumulative count of the anomalies
+    """
+    rank = np.argsort(val, kind = 'stable')
+    val_sorted = val[rank]
+    anomaly_sorted = labels[rank] == 1
+    n_anomaly = np.sum(anomaly_sorted)
+    anomaly_below = np.concatenate([[0], np.cumsum(anomaly_sorted)]) # Number of anomalies among the i smallest values
+    if anomaly_at_top: # Anomaly if the value is larger than the threshold
+        n_below = np.searchsorted(val_sorted, epsilons, side = 'right')
+        n_pred = len(val) - n_below
+        tp = n_anomaly - anomaly_below[n_below]
+    else: # Anomaly if the value is smaller than the threshold
+        n_pred = np.searchsorted(val_sorted, epsilons, side = 'left')
+        tp = anomaly_below[n_pred]
+    fp = n_pred - tp
+    fn = n_anomaly - tp
+    precision = tp / np.maximum(1, tp + fp)
+    recall = tp / np.maximum(1, tp + fn)
+    return (2 * precision * recall) / np.maximum(1, precision + recall)
+
+def select_threshold_cv(val, labels, anomaly_at_top = True, k = 10, folds = 3, n_workers = 1, to_print = False, min_parallel_rows = 10**6):
+    """
+    Select the threshold of select_threshold() with cross validation: for each fold, select_threshold() picks a threshold
+    on the other folds and the threshold is scored on the held-out fold; the median of the fold thresholds is kept,
+    which is less sensitive to a few rows than the best threshold on all the rows
+    - folds: number of (stratified, shuffled) folds, see cv_fold_ids()
+    - n_workers: number of processes that run the folds, see run_cv_tasks()
+    - min_parallel_rows: with fewer rows than this, the folds run inline whatever n_workers is: a fold only takes
+      milliseconds, far less than starting the worker processes
+    """
+    fold_of_row = cv_fold_ids(labels,folds)
+    tasks = [(fold, anomaly_at_top, k) for fold in range(folds)]
+    if len(val) < min_parallel_rows:
+        n_workers = 1
+    fold_results = run_cv_tasks(threshold_cv_task,tasks,{'val': val, 'labels': labels, 'fold_of_row': fold_of_row},n_workers)
+    thresholds = np.array([threshold for threshold, f_test in fold_results])
+    best_epsilon = np.median(thresholds)
+    if to_print: # Print out the held-out scores, then the result with the selected threshold
+        print('Held-out F score of the fold thresholds: ' + ', '.join('{0:.3f}'.format(f_test) for threshold, f_test in fold_results))
+        coef = -1 if anomaly_at_top else 1
+        rank = np.argsort(coef*val)
+        eval_prediction(coef*val[rank] < coef*best_epsilon, labels[rank], k, to_print = to_print)
+    return best_epsilon
+
+def select_threshold_distance(edistance, labels,k=10, to_print = False, folds = None, n_workers = 1):  
     """
     This function finds the best threshold value to detect the anomaly given the euclidean distance and True label Values
+    folds: if given, the threshold is selected with cross validation (see select_threshold_cv()) on n_workers processes
     """
     # The data points at the top (with high distance values) are likely to be anomaly
+    if folds is not None:
+        return select_threshold_cv(edistance, labels, anomaly_at_top = True, k = k, folds = folds, n_workers = n_workers, to_print = to_print)
     best_epsilon = select_threshold(edistance, labels,anomaly_at_top=True,k=k, to_print = to_print)
     return best_epsilon
 
@@ -550,10 +1156,17 @@ def train_test_with_reconstruction_error(data_original_train, data_decoded_train
     """
     Factorize the training and testing process of the Reconstruction Error-based method
     """
-    ## Training
     # Find the euclidean distance between the original dataset and the decoded dataset
     dist_train = find_euclidean_distance(data_decoded_train,data_original_train)
+    dist_test = find_euclidean_distance(data_decoded_test,data_original_test)
+    return train_test_with_distance(dist_train, dist_test, labels_train, labels_test, k, to_print = to_print)
 
+def train_test_with_distance(dist_train, dist_test, labels_train, labels_test, k, to_print = True, folds = None, n_workers = 1):
+    """
+    Training and testing of the Reconstruction Error-based method, given the reconstruction error of each row
+    folds, n_workers: select the threshold with cross validation, see select_threshold_distance()
+    """
+    ## Training
     # Plot of the reconstruction error from high to low
     if to_print: 
         print("Below is a scatter plot that ranks the data points according to their Reconstruction Errors.")
@@ -566,12 +1179,9 @@ def train_test_with_reconstruction_error(data_original_train, data_decoded_train
     if to_print:
         print("Training Results:")
 
-    threshold_error = select_threshold_distance(dist_train, labels_train,k,to_print = to_print)
+    threshold_error = select_threshold_distance(dist_train, labels_train,k,to_print = to_print,folds = folds,n_workers = n_workers)
 
     ## Testing
-    # Find the euclidean distance between the original dataset and the decoded dataset
-    dist_test = find_euclidean_distance(data_decoded_test,data_original_test)
-
     # Sort the Images and Labels based on the Reconstruction Error
     rank_test = np.argsort(-dist_test) # Sort from the Largest to the Smallest
     dist_test_ranked = dist_test[rank_test] # Sort the Reconstruction Error
@@ -588,6 +1198,7 @@ def train_test_with_reconstruction_error(data_original_train, data_decoded_train
         eval_prediction(preds, labels_test_ranked, k,to_print = to_print)
     else: # no print & with return
         results = eval_prediction(preds, labels_test_ranked, k,to_print = to_print)
+        results.threshold = threshold_error # Record the threshold, e.g. to save it with the model
         return results
 
 
@@ -600,29 +1211,136 @@ def select_threshold_probability(p, labels, k=10, to_print = False):
     best_epsilon = select_threshold(p, labels,anomaly_at_top = False, k=k, to_print = to_print)
     return best_epsilon
 
-def estimate_gaussian(X):
+def estimate_gaussian(X,weights=None):
     """
     Compute the parameters of the Gaussian Distribution
     Note: X is given in the shape of m*k, where k is the number of (reduced) dimensions, and m is the number of images
+    weights: optional integer multiplicity of each row (e.g. the counts of the unique rows)
     """
-    mu = np.mean(X,axis=0)
-    cov = np.cov(X,rowvar=0)
+    mu = np.average(X,axis=0,weights=weights) # Accumulated in float64
+    if np.issubdtype(X.dtype, np.floating) and X.dtype != np.float64: # Keep the float type of the data (e.g. float32 encoded data)
+        mu = mu.astype(X.dtype)
+        cov = covariance_matrix(X - mu,weights)
+    else:
+        cov = np.cov(X,rowvar=0,fweights=weights)
 
     return mu, cov
 
-def fit_multivariate_gaussian(data,whitened = False, lam = 0, plot_comparison = False):
+def fit_multivariate_gaussian(data,whitened = False, lam = 0, plot_comparison = False, weights = None, shrinkage = None):
     """
     This function is used to compute the mu and cov based on the given data, and fit a multivariate gaussian dist
     This data is given as a m*k matrix, where m represents the number of samples, and k represents the number of dimensions
-    """
-    mu, cov = estimate_gaussian(data)
+    weights: optional integer multiplicity of each row
+    shrinkage: 'ledoit_wolf' or 'oas' to shrink the covariance toward the identity in closed form (see shrinkage_covariance())
+    """
+    if shrinkage is not None:
+        mu, cov_dist, intensity = shrinkage_covariance(data,shrinkage,weights)
+        if plot_comparison:
+            compare_whiten_cov(estimate_gaussian(data,weights)[1],cov_dist) # Plot for comparison
+        return GaussianModel(mu, cov_dist)
+    mu, cov = estimate_gaussian(data,weights)
     if whitened:
         cov_dist = whitening_cov(cov, lam, plot_comparison)
     else:
         cov_dist = cov # No whitening
-    dist = multivariate_normal(mean = mu, cov = cov_dist,allow_singular=False)
+    dist = GaussianModel(mu, cov_dist)
     return dist
 
+class CholeskyGaussian:
+    """
+    Base class of the multivariate gaussians that score the rows with the Cholesky factor of their covariance
+    (GaussianModel and OnlineGaussianModel).
+    The rows are scored with the log-density: in a few hundred dimensions the density itself underflows to 0
+    for most rows, and the ranking of the rows would collapse into ties.
+    Parameters (set by the subclasses):
+    - mean: the mean vector (length k)
+    - cov_cholesky: the lower triangular factor L of cov = L L^T (in float64)
+    - whitening: L^-1, so the rows are whitened with one matrix product; None to solve with L instead
+      (e.g. when L changes with every batch, and inverting it would cost more than scoring)
+    - log_det: the log-determinant of cov
+    """
+
+    def mahalanobis(self,data,chunk_size = 2**12):
+        """
+        Squared Mahalanobis distance of every row to the mean: ||L^-1 (x - mu)||^2, chunk_size rows at a time
+        """
+        data = np.asarray(data).reshape(-1, len(self.mean))
+        dist_sq = np.empty(len(data))
+        for start in range(0, len(data), chunk_size):
+            data_shifted = np.asarray(data[start:start+chunk_size], dtype = np.float64) - self.mean
+            if self.whitening is not None:
+                z = data_shifted.dot(self.whitening.T)
+            else:
+                z = solve_triangular(self.cov_cholesky, data_shifted.T, lower = True).T
+            dist_sq[start:start+chunk_size] = np.einsum('ij,ij->i', z, z)
+        return dist_sq
+
+    def logpdf(self,data):
+        return -0.5 * (len(self.mean) * np.log(2 * np.pi) + self.log_det + self.mahalanobis(data))
+
+    def pdf(self,data):
+        return np.exp(self.logpdf(data))
+
+class GaussianModel(CholeskyGaussian):
+    """
+    Class for a multivariate gaussian that factors its covariance once (Cholesky), so the training rows, the testing rows
+    and the cross-validation folds are all scored with the same factorization (see CholeskyGaussian).
+    Parameters:
+    - mean: the mean vector (length k)
+    - cov: the covariance matrix (k*k); it must be positive definite
+    - cov_cholesky: the lower triangular factor L of cov = L L^T (computed in float64)
+    - whitening: L^-1, so the rows are whitened with one matrix product instead of a triangular solve per batch
+    - log_det: the log-determinant of cov
+    """
+
+    def __init__(self,mean,cov):
+        self.mean = np.atleast_1d(mean) # Vector of length k
+        self.cov = np.atleast_2d(cov) # Matrix k*k
+        self.cov_cholesky = np.linalg.cholesky(np.asarray(self.cov, dtype = np.float64)) # Raises LinAlgError if cov is singular
+        self.whitening = solve_triangular(self.cov_cholesky, np.identity(len(self.mean)), lower = True) # Lower triangular k*k
+        self.log_det = 2 * np.sum(np.log(np.diag(self.cov_cholesky))) # Double
+
+# Closed-form shrinkage of the covariance toward a scaled identity, without labels or folds:
+# - 'ledoit_wolf': the intensity that minimizes the expected squared error (Ledoit & Wolf, 2004)
+# - 'oas': the Oracle Approximating Shrinkage intensity (Chen et al., 2010), better for few samples
+shrinkage_methods = ['ledoit_wolf','oas']
+
+def shrinkage_covariance(data,method = 'ledoit_wolf',weights = None):
+    """
+    Shrink the covariance of the data toward the identity scaled by the average variance: (1-s)*S + s*mu*I,
+    where S is the maximum-likelihood covariance and the intensity s comes from the data in closed form
+    - method: one of shrinkage_methods
+    - weights: optional integer multiplicity of each row
+    Returns the mean, the shrunk covariance and the shrinkage intensity s
+    """
+    if method not in shrinkage_methods:
+        raise ValueError('Unknown shrinkage method: ' + str(method))
+    data = np.asarray(data, dtype = np.float64)
+    n_samples = len(data) if weights is None else float(np.sum(weights))
+    n_features = data.shape[1]
+    mean = np.average(data,axis = 0,weights = weights)
+    data_shifted = data - mean
+    data_weighted = data_shifted if weights is None else data_shifted * np.asarray(weights)[:,None]
+    emp_cov = data_weighted.T.dot(data_shifted) / n_samples
+    mu = np.trace(emp_cov) / n_features # Average variance: the scale of the identity target
+
+    if method == 'ledoit_wolf':
+        norm_sq = np.einsum('ij,ij->i', data_shifted, data_shifted)
+        beta_ = np.sum(norm_sq**2) if weights is None else np.sum(np.asarray(weights) * norm_sq**2) # Sum of ||x_i||^4
+        delta_ = np.sum(emp_cov**2)
+        beta = (beta_ / n_samples - delta_) / (n_features * n_samples) # Variance of the entries of the covariance estimate
+        delta = (delta_ - 2 * mu * np.trace(emp_cov) + n_features * mu**2) / n_features # Distance to the target: ||S - mu*I||^2 / n
+        intensity = 0.0 if delta == 0 else min(beta, delta) / delta
+    else:
+        alpha = np.mean(emp_cov**2)
+        num = alpha + mu**2
+        den = (n_samples + 1) * (alpha - mu**2 / n_features)
+        intensity = 1.0 if den == 0 else min(num / den, 1.0)
+
+    cov = (1 - intensity) * emp_cov
+    cov.flat[::n_features + 1] += intensity * mu
+    return mean, cov, intensity
+
 def whitening_cov(cov,lam,plot_comparison = False):
     """
     This function whitenes the covariance matrix in order to make features less correlated with one another
@@ -635,7 +1353,7 @@ def whitening_cov(cov,lam,plot_comparison = False):
         compare_whiten_cov(cov,cov_whitened) # Plot for comparison
     return cov_whitened
 
-def train_test_with_gaussian(data_train, data_test, labels_train, labels_test, k,whitened = False, folds = 3, plot_comparison = False,to_print = True):
+def train_test_with_gaussian(data_train, data_test, labels_train, labels_test, k,whitened = False, folds = 3, plot_comparison = False,to_print = True,unique_train = None,unique_test = None,shrinkage = None,n_workers = 1):
     """
     Factorize the training and testing process of the Multivariate Gaussian-based method.
     Note:
@@ -643,31 +1361,55 @@ def train_test_with_gaussian(data_train, data_test, labels_train, labels_test, k
     - lam: the coefficient lambda for whitening the covariance
     - folds: number of folds used in k-fold cross validation
     - plot_comparison: trigger to plot the original covariance and whitened covariance for comparison
+    - unique_train, unique_test: UniqueRows of the training and testing set; if given, data_train and data_test
+      hold one row per unique pattern, and the fit is weighted by the pattern counts
+    - shrinkage: 'ledoit_wolf' or 'oas' to shrink the covariance in closed form instead of whitening it with cross validation
+    - n_workers: number of processes of the cross validation, see run_cv_tasks()
     """
     ## Training
-    if whitened:
+    dist = fit_gaussian_model(data_train, labels_train, k, whitened = whitened, folds = folds, plot_comparison = plot_comparison, to_print = to_print, unique_train = unique_train, shrinkage = shrinkage, n_workers = n_workers)
+
+    # Get the log-density of being Normal: it ranks the rows as the probability does, without underflowing to 0
+    p_train = dist.logpdf(data_train)   # Log-density of Being Normal
+    p_test = dist.logpdf(data_test)   # Log-density of Being Normal
+    if unique_train is not None: # Copy the log-density of each pattern to its rows
+        p_train = unique_train.expand(p_train)
+        p_test = unique_test.expand(p_test)
+    return train_test_with_probability(p_train, p_test, labels_train, labels_test, k, to_print = to_print)
+
+def fit_gaussian_model(data_train, labels_train, k, whitened = False, folds = 3, plot_comparison = False, to_print = True, unique_train = None, shrinkage = None, n_workers = 1):
+    """
+    Fit the Multivariate Gaussian model of train_test_with_gaussian() and return the fitted GaussianModel
+    """
+    if shrinkage is not None:
+        # Shrink the covariance toward the identity: one pass over the data, no labels and no folds
+        weights = None if unique_train is None else unique_train.counts
+        dist = fit_multivariate_gaussian(data_train,plot_comparison=plot_comparison,weights=weights,shrinkage=shrinkage)
+    elif whitened:
         # Apply Cross-Validation to find the best lambda
-        dist = fit_gaussian_with_whiten_and_cv(data_train,labels_train,folds,k,to_print=to_print)
+        # The folds are drawn over the original rows
+        data_train_rows = data_train if unique_train is None else unique_train.expand(data_train)
+        dist = fit_gaussian_with_whiten_and_cv(data_train_rows,labels_train,folds,k,to_print=to_print,n_workers=n_workers)
     else:
         # Get Gaussian Distribution Model with the Training Data
         # Note: fit_multivariate_gaussian() is my own coded function
-        dist = fit_multivariate_gaussian(data_train,plot_comparison=to_print)
-
-    # Get Probability of being Anomaly vs. being Normal
-    p_train = dist.pdf(data_train)   # Probability of Being Normal
+        weights = None if unique_train is None else unique_train.counts
+        dist = fit_multivariate_gaussian(data_train,plot_comparison=to_print,weights=weights)
+    return dist
 
+def train_test_with_probability(p_train, p_test, labels_train, labels_test, k, to_print = True):
+    """
+    Training and testing of the Multivariate Gaussian-based method, given the log-density (or the probability) of each row
+    """
     ## Print training results
     # Plot the Probability with labels
     if to_print:
-        plot_scatter_with_labels(p_train, labels_train,'Gaussian Probability')
+        plot_scatter_with_labels(p_train, labels_train,'Gaussian Log-Density')
         # Train the Anomaly Detector
         print("Training Results:")
     threshold_gaussian  = select_threshold_probability(p_train, labels_train, k, to_print = to_print)
 
     ## Testing
-    # Find the euclidean distance between the reconstructed dataset and the original ()
-    p_test = dist.pdf(data_test)   # Probability of Being Normal
-
     # Sort the Images and Labels based on the Probability
     rank_test = np.argsort(p_test) # Sort from the Smallest to the Largest
     p_test_ranked = p_test[rank_test] # Sort the distance
@@ -683,71 +1425,48 @@ def train_test_with_gaussian(data_train, data_test, labels_train, labels_test, k
         eval_prediction(preds, labels_test_ranked, k,to_print = to_print)
     else: # no print & with return
         results = eval_prediction(preds, labels_test_ranked, k,to_print = to_print)
+        results.threshold = threshold_gaussian # Record the threshold, e.g. to save it with the model
         return results
 
-def fit_gaussian_with_whiten_and_cv(data,labels,folds,k,to_print = True):
+def fit_gaussian_with_whiten_and_cv(data,labels,folds,k,to_print = True,lam_list = None,n_workers = 1):
     """
     Here we fit a multivariate gaussian with whitening and cross validation
     to_print: if true, plot the comparison between the original and whitened cov
-    """
-    kf = KFold(n_splits = folds) # Create multiple folds for cross validation (cv)
-    best_target_avg = -1 # Intialize a variable to record the best avg target
+    lam_list: the lambdas to evaluate; by default 0, 0.09, ..., 0.99
+    n_workers: number of processes that evaluate the (fold, lambdas) tasks, see run_cv_tasks()
+    The statistics of each fold are accumulated once, and the whitened covariance of every lambda shares the
+    eigenvectors of the covariance, so each fold costs one eigendecomposition for the whole lambda path
+    (see whitened_log_density_path()); a much finer lam_list costs little more than the threshold search.
+    """
+    if lam_list is None:
+        lam_list = list(frange(0,0.999,0.09)) # Possible lambdas (discretized)
     target_name = 'F-score' # Used in plot
-    lam_list = [] # list to record the lambda - for the plot
-    target_avg_list = []
-    rprec_avg_list = [] # list to record the average RPrec corresponding to each lambda - used for the plot
-    preck_avg_list = []
-    
-    for lam in frange(0,0.999,0.09): # Loop through each possible lambda (discretized)
-        target_list = []
-        rprec_list = [] # Initialize a list to record the f1 score of each training & testing set combination
-        preck_list = [] 
-        for train_index, test_index in kf.split(data):
-            
-            # Training
-            # training Use whitened covariance to fit a multivariate gaussian distribution
-            data_train = data[train_index] # Get training set data
-            labels_train = labels[train_index] # Get training set labels
-            dist = fit_multivariate_gaussian(data_train,whitened=True,lam = lam) # Fit in a distribution 
-            p_train = dist.pdf(data_train)   # Probability of Being Normal
-            threshold_gaussian  = select_threshold_probability(p_train, labels_train, k, to_print = False) # Find the best threshold with the training set
-
-            # Testing
-            data_test = data[test_index] # Get the testing data
-            labels_test = labels[test_index]
-            p_test = dist.pdf(data_test)   # Probability of Being Normal
-
-            # Sort the Images and Labels based on the Probability
-            rank_test = np.argsort(p_test) # Sort from the Smallest to the Largest
-            p_test_ranked = p_test[rank_test] # Sort the distance
-            labels_test_ranked = labels_test[rank_test] # Rank Labels
-
-            # Give Predictions
-            preds = np.zeros(labels_test_ranked.shape) # Initialization
-            preds[p_test_ranked < threshold_gaussian] = 1 # If the probability is smaller than the threshold, marked as anomaly
-
-            results = eval_prediction(preds,labels_test_ranked,k)
-            target = results.F # Set the F score as the target to optimize
-            target_list.append(target) # Save the f1 score of the current training & testing combination
-            preck_list.append(results.PrecK)
-            rprec_list.append(results.RPrec)
-
-        target_avg = sum(target_list)/len(target_list) # The average target for the current lambda
-        rprec_avg = sum(rprec_list)/len(rprec_list)
-        preck_avg = sum(preck_list)/len(preck_list)
-
-        # Save the current lambda and rprec_avg
-        lam_list.append(lam)
-        target_avg_list.append(target_avg)
-        rprec_avg_list.append(rprec_avg)
-        preck_avg_list.append(preck_avg)
-
-        # Optimize to find the highest target
-        if target_avg > best_target_avg:
-            best_lam = lam # Record the current lambda
-            best_target_avg = target_avg # Record the current target measurement
-        if to_print: # Print out the milestone
-            print('Finish evaluate Lambda: ' + str(lam))
+
+    # Count, mean and scatter matrix of each fold, in one pass over the data
+    fold_of_row = cv_fold_ids(labels,folds) # Create multiple folds for cross validation (cv)
+    fold_stats = class_statistics(data,fold_of_row)
+
+    # One task per fold and block of lambdas; the training statistics of a fold are all the other folds
+    tasks = []
+    for fold in range(folds):
+        train_stats = combine_class_statistics(fold_stats,exclude = (fold,))
+        for start in range(0, len(lam_list), cv_lam_block_size):
+            tasks.append((fold, train_stats, lam_list[start:start+cv_lam_block_size], k))
+    task_results = run_cv_tasks(whitened_cv_task,tasks,{'data': data, 'labels': labels, 'fold_of_row': fold_of_row},n_workers)
+
+    # Record the f1 score, R-Precision and Precision@k of each training & testing set combination and lambda
+    # The tasks are ordered by fold, then by lambda
+    scores = np.array([scores_lam for block_scores in task_results for scores_lam in block_scores]).reshape(folds,len(lam_list),3)
+    target_matrix, rprec_matrix, preck_matrix = scores[:,:,0], scores[:,:,1], scores[:,:,2]
+    if to_print: # Print out the milestone
+        print('Finish evaluate ' + str(folds) + ' folds * ' + str(len(lam_list)) + ' lambdas')
+
+    # The average target of each lambda
+    target_avg_list = np.mean(target_matrix,axis = 0)
+    rprec_avg_list = np.mean(rprec_matrix,axis = 0)
+    preck_avg_list = np.mean(preck_matrix,axis = 0)
+    # Optimize to find the highest target (the first one if there are ties)
+    best_lam = lam_list[int(np.argmax(target_avg_list))]
 
     if to_print:
         plt.figure(figsize=(15,8))
@@ -780,6 +1499,61 @@ def fit_gaussian_with_whiten_and_cv(data,labels,folds,k,to_print = True):
     dist = fit_multivariate_gaussian(data, whitened = True,lam = best_lam)
     return dist
 
+def whitened_cv_task(task):
+    """
+    Cross-validation task of fit_gaussian_with_whiten_and_cv(): for one fold and a block of lambdas, find the best
+    threshold on the training rows and test it on the rows of the fold.
+    The data, labels and fold ids are read from the shared arrays (see run_cv_tasks())
+    Returns the (F-score, R-Precision, Precision@k) of every lambda of the block
+    """
+    fold, train_stats, lam_list, k = task
+    data, labels, fold_of_row = cv_shared_arrays['data'], cv_shared_arrays['labels'], cv_shared_arrays['fold_of_row']
+    p = whitened_log_density_path(data,train_stats,lam_list) # Log-density of Being Normal, one column per lambda
+    ind_train = fold_of_row != fold
+    ind_test = fold_of_row == fold
+    labels_train = labels[ind_train] # Get training set labels
+    labels_test = labels[ind_test]
+
+    scores = []
+    for i, lam in enumerate(lam_list):
+        # Training: find the best threshold with the training set
+        threshold_gaussian  = select_threshold_probability(p[ind_train,i], labels_train, k, to_print = False)
+
+        # Testing
+        p_test = p[ind_test,i]
+
+        # Sort the Images and Labels based on the Probability
+        rank_test = np.argsort(p_test) # Sort from the Smallest to the Largest
+        p_test_ranked = p_test[rank_test] # Sort the distance
+        labels_test_ranked = labels_test[rank_test] # Rank Labels
+
+        # Give Predictions
+        preds = np.zeros(labels_test_ranked.shape) # Initialization
+        preds[p_test_ranked < threshold_gaussian] = 1 # If the probability is smaller than the threshold, marked as anomaly
+
+        results = eval_prediction(preds,labels_test_ranked,k)
+        scores.append((results.F, results.RPrec, results.PrecK)) # The F score is the target to optimize
+    return scores
+
+def whitened_log_density_path(data,accumulator,lam_list,chunk_size = 2**12):
+    """
+    Log-density of every row under the gaussian of the accumulated statistics, whitened with every lambda in lam_list
+    With the covariance C = V diag(e) V^T, the whitened covariance lam*C + (1-lam)*I (see whitening_cov()) is
+    V diag(lam*e + 1-lam) V^T: the rows are projected on V once, and each lambda only shifts the eigenvalues.
+    Returns a matrix of size m * len(lam_list)
+    """
+    eigen_value, eigen_vector = np.linalg.eigh(accumulator.covariance())
+    lam = np.asarray(lam_list, dtype = np.float64)
+    shifted = lam[None,:] * eigen_value[:,None] + (1 - lam)[None,:] # Eigenvalues of each whitened covariance: k * len(lam_list)
+    log_det = np.sum(np.log(shifted), axis = 0)
+    n_features = len(eigen_value)
+    log_density = np.empty((len(data),len(lam)))
+    for start in range(0, len(data), chunk_size):
+        z = (np.asarray(data[start:start+chunk_size], dtype = np.float64) - accumulator.mean).dot(eigen_vector)
+        mahalanobis = (z**2).dot(1 / shifted) # Squared Mahalanobis distance for every lambda
+        log_density[start:start+chunk_size] = -0.5 * (n_features * np.log(2 * np.pi) + log_det + mahalanobis)
+    return log_density
+
 ## Support Functions for Performance Evaluation
 def eval_prediction(pred,labels,k=10, to_print = False):
     """
@@ -1011,7 +1785,7 @@ def plot_encoded_data_2d_pca(AnomalyData,data, labels):
     Note: the input data has a shape of m*n, where m is the sample size and n is # of dimensions
     """
     # Compute PCA with training dataset
-    data_encoded,n,m = pca_all_processes(data,labels,AnomalyData.n_components,decode = False)
+    data_encoded,n,m = pca_all_processes(data,labels,AnomalyData.n_components,decode = False,solver = AnomalyData.pca_solver,dtype = AnomalyData.dtype)
     
     # Print the % variance achieved with 2 PC
     #compare_var(data,data_encoded, to_print = True)
@@ -1192,39 +1966,133 @@ def check_eigen(eigen_value, eigen_vector,cov_matrix):
         eigv = eigen_vector[:,i].reshape(1,n).T 
         np.testing.assert_array_almost_equal(cov_matrix.dot(eigv), eigen_value[i] * eigv, decimal=6, err_msg='', verbose=True)
      
-def compute_pca_matrix(data):
+# Eigensolvers of compute_pca_matrix():
+# - 'full': all the eigenvectors of the covariance (symmetric solver)
+# - 'eigsh': only the top n_components eigenvectors, with a partial symmetric eigensolver (Lanczos)
+# - 'randomized': only the top n_components eigenvectors, with a randomized range finder (see randomized_eigh())
+pca_solvers = ['full','eigsh','randomized']
+
+# Float type of the PCA, Gaussian and distance computations; AnomalyData.dtype overrides it for one dataset
+# With np.float32 the data, the covariance, the PCA Matrix and the encoded data stay in single precision
+# (half the memory traffic, faster BLAS); the means and the streaming statistics are still accumulated in float64
+compute_dtype = np.float64
+
+def set_compute_dtype(dtype):
+    """
+    Set the default float type of the PCA, Gaussian and distance computations (np.float32 or np.float64)
+    """
+    global compute_dtype
+    compute_dtype = np.dtype(dtype).type
+
+def float_dtype(dtype = None):
+    """
+    The float type to compute with: the given dtype, or compute_dtype if it is None
+    """
+    return np.dtype(compute_dtype if dtype is None else dtype)
+
+def covariance_matrix(data_shifted,weights = None):
+    """
+    Covariance of mean-shifted data in its own float type (np.cov always computes in float64)
+    """
+    if data_shifted.dtype == np.float64:
+        return np.cov(data_shifted, rowvar=0, fweights=weights) # important to add rowvar to specify the axis
+    n_samples = len(data_shifted) if weights is None else np.sum(weights)
+    data_weighted = data_shifted if weights is None else data_shifted * np.asarray(weights, dtype = data_shifted.dtype)[:,None]
+    return data_weighted.T.dot(data_shifted) / data_shifted.dtype.type(n_samples - 1)
+
+def randomized_eigh(matrix,n_components,oversampling = 10,n_iter = 4):
+    """
+    Approximate the top n_components eigenpairs of a symmetric positive semi-definite matrix (n*n):
+    the matrix is applied to n_components + oversampling random directions, refined with n_iter power iterations,
+    and the small projected matrix is solved exactly.
+    More oversampling and more iterations give a more accurate basis at a higher cost.
+    """
+    n_features = matrix.shape[0]
+    n_directions = min(n_features, n_components + oversampling)
+    basis, _ = np.linalg.qr(matrix.dot(np.random.standard_normal((n_features,n_directions)).astype(matrix.dtype)))
+    for i in range(n_iter): # Power iterations: separate the top eigenvectors from the rest
+        basis, _ = np.linalg.qr(matrix.dot(basis))
+    eigen_value, eigen_vector_small = np.linalg.eigh(basis.T.dot(matrix).dot(basis))
+    return eigen_value, basis.dot(eigen_vector_small)
+
+def sorted_eigenvectors(matrix,n_components=None,solver='full',oversampling=10,n_iter=4):
+    """
+    Eigenvalues and eigenvectors of a symmetric matrix, sorted by eigenvalue from large to small.
+    With a truncated solver ('eigsh' or 'randomized') only the top n_components are computed and returned.
+    """
+    if solver not in pca_solvers:
+        raise ValueError('Unknown PCA solver: ' + str(solver))
+    truncated = solver != 'full' and n_components is not None and 0 < n_components < matrix.shape[0]
+    if not truncated:
+        eigen_value, eigen_vector = np.linalg.eigh(matrix)
+    elif solver == 'eigsh':
+        eigen_value, eigen_vector = eigsh(matrix, k = n_components, which = 'LA') # The largest eigenvalues only
+    else:
+        eigen_value, eigen_vector = randomized_eigh(matrix, n_components, oversampling, n_iter)
+
+    # Sort the eigenvectors by eigenvalues from large to small 
+    order = np.argsort(-np.abs(eigen_value), kind = 'stable')
+    if truncated:
+        order = order[:n_components]
+    return eigen_value[order], eigen_vector[:,order]
+
+def compute_pca_matrix(data,weights=None,n_components=None,solver='full',oversampling=10,n_iter=4,return_eigen_value=False,dtype=None):
     """
     Compute PCA Matrix with the given data
     data: a matrix of size m*n, where m is the number of samples, and n is the # dimensions
-    """
+    weights: optional integer multiplicity of each row (e.g. the counts of the unique rows)
+    n_components, solver: the 'full' solver returns all the n eigenvectors (n*n matrix);
+    'eigsh' and 'randomized' compute and return only the top n_components (n*k matrix), see pca_solvers
+    oversampling, n_iter: accuracy settings of the 'randomized' solver, see randomized_eigh()
+    If there are fewer samples than dimensions (m < n, e.g. full-size faces), the n*n covariance is never built:
+    the eigenvectors come from the m*m Gram matrix, and at most m of them are returned (see dual_pca_matrix())
+    return_eigen_value: if True, the eigenvalues (the variance along each column of the PCA Matrix) are returned as well
+    dtype: the float type of the computation (see compute_dtype); the mean is accumulated in float64 either way
+    """
+    dtype = float_dtype(dtype)
     # Record the shape of the data: number of features in columns
-    n_features = data.shape[1]
+    n_samples, n_features = data.shape
 
     # Take a mean shift
-    component_mean = np.mean(data,axis = 0) # Take mean of each column
-    data_shifted = mean_shift(data,component_mean) 
+    component_mean = np.average(data,axis = 0,weights = weights).astype(dtype) # Take mean of each column
+    data_shifted = mean_shift(np.asarray(data,dtype = dtype),component_mean) 
 
-    # compute the covariance matrix of the image matrix
-    cov_matrix = np.cov(data_shifted, rowvar=0) # important to add rowvar to specify the axis
-    # Compute the eigen value and eigen vectors, where eigenvalue is a vector of length n, and eigenvector is a square matrix of size n*n
-    eigen_value, eigen_vector = np.linalg.eig(cov_matrix)
-
-    # Sort the eigenvectors by eigenvalues from large to small 
-    # First make a list of (eigenvalue, eigenvector) tuples 
-    eig_pairs = [(np.abs(eigen_value[i]), eigen_vector[:,i]) for i in range(len(eigen_value))] 
-    # Sort the (eigenvalue, eigenvector) tuples from high to low 
-    eig_pairs.sort(key=lambda x: x[0], reverse=True)
+    if n_samples < n_features:
+        pca_matrix, eigen_value = dual_pca_matrix(data_shifted,weights,n_components,solver,oversampling,n_iter)
+        if return_eigen_value:
+            return pca_matrix, component_mean, eigen_value
+        return pca_matrix, component_mean
 
-    # Convert the sorted eigen vector list to matrix form
-    pca_matrix = np.zeros((n_features,n_features))
-    for i in range(0,len(eig_pairs)):
-        pca_matrix[:,i] = eig_pairs[i][1]
+    # compute the covariance matrix of the image matrix
+    cov_matrix = covariance_matrix(data_shifted,weights)
+    # Compute the eigen values and eigen vectors of the symmetric covariance matrix, sorted from large to small
+    eigen_value, pca_matrix = sorted_eigenvectors(cov_matrix,n_components,solver,oversampling,n_iter)
 
     # output: 
-    # pca_matrix: sorted eigenvectors in a n*n matrix
+    # pca_matrix: sorted eigenvectors in a n*n matrix (n*k with a truncated solver)
     # mean: the mean of the original input data (across each dimension)
+    if return_eigen_value:
+        return pca_matrix, component_mean, eigen_value
     return pca_matrix, component_mean
 
+def dual_pca_matrix(data_shifted,weights=None,n_components=None,solver='full',oversampling=10,n_iter=4):
+    """
+    PCA through the Gram matrix, for data with fewer samples (m) than dimensions (n)
+    With X the mean-shifted data, X^T X (n*n) and X X^T (m*m) share their non-zero eigenvalues,
+    and an eigenvector u of X X^T gives the eigenvector X^T u / sqrt(eigenvalue) of X^T X.
+    Returns the eigenvectors with a non-zero eigenvalue (at most m), sorted from large to small, as a n*m matrix,
+    and their eigenvalues scaled as the eigenvalues of the covariance matrix
+    """
+    if weights is not None: # Row multiplicities: X^T W X = (W^1/2 X)^T (W^1/2 X)
+        data_shifted = data_shifted * np.sqrt(weights).astype(data_shifted.dtype)[:,None]
+    gram_matrix = data_shifted.dot(data_shifted.T)
+    eigen_value, eigen_vector = sorted_eigenvectors(gram_matrix,n_components,solver,oversampling,n_iter)
+    nonzero = eigen_value > max(eigen_value.max(),0) * 1e-10 # The centered data has rank m-1 at most
+    # Map the eigenvectors back to the image space; they have a unit norm
+    pca_matrix = data_shifted.T.dot(eigen_vector[:,nonzero]) / np.sqrt(eigen_value[nonzero])
+    n_samples = len(data_shifted) if weights is None else np.sum(weights)
+    return pca_matrix, eigen_value[nonzero] / eigen_value.dtype.type(n_samples - 1) # Same normalization as np.cov
+
 def encode_pca(data, component_mean, pca_matrix, n_components):
     """
     Encode the data with PCA Matrix:
@@ -1266,7 +2134,55 @@ def reconstruct_with_pca(data, component_mean, pca_matrix, n_components):
     data_decoded = decode_pca(data_encoded, component_mean, pca_matrix, n_components)
     return data_decoded
 
-def pca_all_processes(data,labels,n_components, plot_eigenfaces_bool = False,decode = True, plot_comparison_bool = False, height = 0,width = 0):
+def pca_reconstruction_error(data, component_mean, pca_matrix, n_components, chunk_size = 2**14):
+    """
+    Reconstruction error of every row with pca, the same as find_euclidean_distance(reconstruct_with_pca(data, ...), data),
+    without building the decoded data: for a row x with the scores z = P_k^T (x - mu),
+    ||x - reconstruction||^2 = ||x - mu||^2 - ||z||^2 since the columns of the PCA Matrix are orthonormal.
+    The rows are processed chunk_size at a time, so the memory use does not grow with the number of rows.
+    Rows whose error is tiny compared to ||x - mu|| (where the subtraction loses precision) get the explicit residual.
+    The computation runs in the float type of the PCA Matrix (see compute_dtype).
+    """
+    pca_matrix_k = pca_matrix[:,:n_components]
+    tolerance = np.sqrt(np.finfo(pca_matrix.dtype).eps) # Relative size of the error below which the subtraction is not trusted
+    dist = np.empty(len(data))
+    for start in range(0, len(data), chunk_size):
+        data_shifted = mean_shift(np.asarray(data[start:start+chunk_size], dtype = pca_matrix.dtype), component_mean)
+        scores = data_shifted.dot(pca_matrix_k)
+        norm_sq = np.einsum('ij,ij->i', data_shifted, data_shifted)
+        error_sq = norm_sq - np.einsum('ij,ij->i', scores, scores)
+        inexact = error_sq < tolerance * norm_sq
+        if np.any(inexact):
+            residual = data_shifted[inexact] - scores[inexact].dot(pca_matrix_k.T)
+            error_sq[inexact] = np.einsum('ij,ij->i', residual, residual)
+        dist[start:start+chunk_size] = np.sqrt(error_sq)
+    return dist
+
+def pca_reconstruction_error_sweep(data, component_mean, pca_matrix, n_components_list, chunk_size = 2**12):
+    """
+    Reconstruction error of every row for every number of components in n_components_list, from one projection:
+    with the scores z = P^T (x - mu) on the whole basis, the squared error with k components is the sum of z_j^2 for j >= k
+    (plus the part of x - mu outside of the basis, if any), so every k follows from one reverse cumulative sum.
+    Returns a matrix of size m * len(n_components_list)
+    """
+    n_components_list = np.asarray(n_components_list)
+    n_basis = pca_matrix.shape[1]
+    ind = np.minimum(n_components_list, n_basis) # More components than the basis holds give the same reconstruction
+    dist = np.empty((len(data),len(n_components_list)))
+    for start in range(0, len(data), chunk_size):
+        data_shifted = mean_shift(np.asarray(data[start:start+chunk_size], dtype = pca_matrix.dtype), component_mean)
+        scores_sq = data_shifted.dot(pca_matrix)**2
+        # tail_sq[:,k] = sum of the squared scores of the components k, k+1, ... (0 for k = n_basis)
+        tail_sq = np.zeros((len(scores_sq),n_basis+1),dtype = scores_sq.dtype)
+        tail_sq[:,:n_basis] = np.cumsum(scores_sq[:,::-1], axis = 1)[:,::-1]
+        if n_basis == pca_matrix.shape[0]: # A complete basis leaves nothing outside
+            outside_sq = np.zeros(len(scores_sq))
+        else:
+            outside_sq = np.maximum(np.einsum('ij,ij->i', data_shifted, data_shifted) - tail_sq[:,0], 0)
+        dist[start:start+chunk_size] = np.sqrt(outside_sq[:,None] + tail_sq[:,ind])
+    return dist
+
+def pca_all_processes(data,labels,n_components, plot_eigenfaces_bool = False,decode = True, plot_comparison_bool = False, height = 0,width = 0, weights = None, solver = 'full', use_cache = False, dtype = None):
     """
     Factorize the process of pca computation and reconstruction in one function
     data: in a matrix form with shape m*n
@@ -1274,9 +2190,14 @@ def pca_all_processes(data,labels,n_components, plot_eigenfaces_bool = False,dec
     n_components, number of components after pca encoding
     plot_eigenfaces: trigger to plot the eigenfaces of the image, if True, the height and width of the image should be given
     plot_comparison: trigger to plot the comparison between the original and the reconstructed images; same as above, if true, the height and width of the image should be given
+    weights: optional number of normal samples behind each row (e.g. UniqueRows.normal_counts)
+    solver: the eigensolver of compute_pca_matrix(); a truncated solver computes only the n_components columns
+    use_cache: reuse the fit (and the encoded data) of an earlier call with the same data, see get_pca_fit()
+    dtype: the float type of the computation, see compute_dtype
     """
     # Compute PCA Matrix: with the normal data only
-    pca_matrix, component_mean = compute_pca_matrix(data[labels == 0])
+    fit, data_fingerprint = get_pca_fit(data,labels,n_components,weights,solver,use_cache,dtype)
+    pca_matrix, component_mean = fit.pca_matrix, fit.component_mean
 
     if (plot_eigenfaces_bool and height*width !=0): # Plot the eigenfaces only if the data is of the type image
         # Visualize the eigenfaces with the pca matrix
@@ -1295,6 +2216,9 @@ def pca_all_processes(data,labels,n_components, plot_eigenfaces_bool = False,dec
             print()
         return data_decoded, pca_matrix, component_mean
 
+    elif use_cache:
+        data_encoded = pca_fit_cache.encode(fit, data, data_fingerprint)
+        return data_encoded, pca_matrix, component_mean
     else:
         data_encoded = encode_pca(data, component_mean, pca_matrix, n_components)
         return data_encoded, pca_matrix, component_mean
@@ -1350,36 +2274,676 @@ def compare_var(data, data_pca,to_print = False):
         print()
     return var_retained
 
+def variance_retained_curve(data,labels,chunk_size = 2**12):
+    '''
+    The % variance retained with the PCA Reconstruction (as computed by compare_var()) for every number of
+    components from 0 to n, from a single PCA fit and a single projection of the data:
+    with the reconstruction mu + P_k P_k^T (x - mu), the sum and the sum of squares of the reconstructed data
+    only need the cumulative sums of the scores and of the squared scores over the components.
+    Returns a vector of length n+1: the value at index k is the variance retained with k components
+    '''
+    n_samples, n_features = data.shape
+    pca_matrix, component_mean = compute_pca_matrix(data[labels == 0])
+    n_basis = pca_matrix.shape[1] # n, or fewer with the Gram matrix PCA
+
+    # Sums of the scores and of the squared scores of every component, over all the rows
+    score_sum = np.zeros(n_basis)
+    score_sq_sum = np.zeros(n_basis)
+    data_sum = 0.0
+    data_sq_sum = 0.0
+    for start in range(0, n_samples, chunk_size):
+        chunk = np.asarray(data[start:start+chunk_size], dtype = np.float64)
+        scores = mean_shift(chunk,component_mean).dot(pca_matrix)
+        score_sum += scores.sum(axis = 0)
+        score_sq_sum += (scores**2).sum(axis = 0)
+        data_sum += chunk.sum()
+        data_sq_sum += (chunk**2).sum()
+
+    # Sum and sum of squares of the reconstructed data with k = 0 ... n_basis components
+    mean_proj = pca_matrix.T.dot(component_mean) # mu^T p_j
+    ones_proj = pca_matrix.sum(axis = 0) # 1^T p_j
+    reconst_sum = n_samples*component_mean.sum() + np.concatenate(([0], np.cumsum(ones_proj*score_sum)))
+    reconst_sq_sum = n_samples*component_mean.dot(component_mean) + np.concatenate(([0], np.cumsum(2*mean_proj*score_sum + score_sq_sum)))
+
+    n_values = n_samples*n_features
+    var_reconst = reconst_sq_sum/n_values - (reconst_sum/n_values)**2
+    var_data = data_sq_sum/n_values - (data_sum/n_values)**2
+    var_retained = var_reconst/var_data
+    # More components than the basis holds give the same reconstruction
+    return np.concatenate((var_retained, np.repeat(var_retained[-1], n_features - n_basis)))
+
+def select_n_components(data,labels,var_target = 0.95):
+    '''
+    The smallest number of components that retains var_target of the variance, and the whole curve
+    '''
+    var_retained = variance_retained_curve(data,labels)
+    n_components = int(np.argmax(var_retained >= var_target)) if np.any(var_retained >= var_target) else len(var_retained)-1
+    return n_components, var_retained
+
 def evaludate_pc(data,labels):
     '''
     Evaluate the % variance retained with different number of pc
     '''
-    var_retained_list = []
-    n_components_list = []
-    n_steps = 50 # To save the speed, in maximum we will evaluate 50 PC#s
+    var_retained = variance_retained_curve(data,labels) # Every number of PC at once
+    n_steps = 50 # Number of PC#s shown in the plot
     step_size = max(int(data.shape[1]/n_steps),1) 
-    for n_components in range(0,data.shape[1]+1,step_size):
-        data_pca,pca_matrix, component_mean = pca_all_processes(data,labels,n_components)
-        var_retained = compare_var(data, data_pca)
-        var_retained_list.append(var_retained)
-        n_components_list.append(n_components)
+    n_components_list = list(range(0,data.shape[1]+1,step_size))
+    var_retained_list = var_retained[n_components_list]
     plt.plot(n_components_list,var_retained_list)
     plt.xlabel('# Components Retained after encoding')
     plt.ylabel('Varaince Retained with PCA Reconstruction')
     plt.title('Evaluation of the number of PC retained in PCA')
     plt.show()
+    return var_retained
 
 
 
+## Support Functions for the PCA Cache
+class PCAFit:
+    """
+    Class to record a fitted PCA and the data encoded with it, so that the PCA detectors share one fit
+    Parameters:
+    - pca_matrix: the sorted eigenvectors, see compute_pca_matrix()
+    - component_mean: the mean of the normal training data
+    - n_components: number of components used for encoding
+    - eigen_value: the variance along each column of the PCA Matrix
+    - gaussian: the multivariate gaussian of all the training rows encoded with the fit, if it is known without encoding
+      them (see leave_one_class_out_gaussian()); the PCA Gaussian detector then uses it instead of refitting
+    - encoded: a dictionary of data fingerprint -> encoded data
+    """
+
+    def __init__(self,pca_matrix,component_mean,n_components,eigen_value=None,gaussian=None):
+        self.pca_matrix = pca_matrix # Matrix n*n (or n*k)
+        self.component_mean = component_mean # Vector of length n
+        self.n_components = n_components # Integer
+        self.eigen_value = eigen_value # Vector of length n (or k)
+        self.gaussian = gaussian # GaussianModel or None
+        self.encoded = {} # Dictionary: fingerprint -> matrix m*k
+
+    def nbytes(self):
+        return self.pca_matrix.nbytes + self.component_mean.nbytes + sum(encoded.nbytes for encoded in self.encoded.values())
+
+class PCAFitCache:
+    """
+    Least-recently-used cache of PCA fits, keyed by a fingerprint of the training data, labels, weights and settings
+    Parameters:
+    - max_bytes: the fits (and their encoded data) that are used the least recently are dropped above this size
+    - fits: an ordered dictionary of key -> PCAFit, from the least to the most recently used
+    """
+
+    def __init__(self,max_bytes = 2**30):
+        self.max_bytes = max_bytes # Integer
+        self.fits = OrderedDict() # Ordered dictionary: key -> PCAFit
+
+    def get(self,key):
+        fit = self.fits.get(key)
+        if fit is not None:
+            self.fits.move_to_end(key)
+        return fit
+
+    def put(self,key,fit):
+        self.fits[key] = fit
+        self.fits.move_to_end(key)
+        self.evict()
+
+    def encode(self,fit,data,fingerprint = None,use_cache = True):
+        """
+        Encode the data with the fit, or reuse the encoding if the same data has been encoded before
+        use_cache: if False, encode the data without hashing it or keeping the encoding
+        """
+        if not use_cache:
+            return encode_pca(data, fit.component_mean, fit.pca_matrix, fit.n_components)
+        if fingerprint is None:
+            fingerprint = array_fingerprint(data)
+        if fingerprint not in fit.encoded:
+            fit.encoded[fingerprint] = encode_pca(data, fit.component_mean, fit.pca_matrix, fit.n_components)
+            self.evict()
+        return fit.encoded[fingerprint]
+
+    def evict(self):
+        """
+        Drop the least recently used fits until the cache fits in max_bytes (the last fit is always kept)
+        """
+        while len(self.fits) > 1 and sum(fit.nbytes() for fit in self.fits.values()) > self.max_bytes:
+            self.fits.popitem(last = False)
+
+    def clear(self):
+        self.fits.clear()
+
+pca_fit_cache = PCAFitCache() # Shared by the PCA detectors
+
+def array_fingerprint(array,chunk_rows = 2**16):
+    """
+    Hash of the shape, dtype and content of an array, read chunk by chunk (works on memory maps)
+    """
+    if array is None:
+        return None
+    array = np.asarray(array) if not isinstance(array, np.ndarray) else array
+    digest = hashlib.sha1(str((array.shape, array.dtype.str)).encode())
+    for start in range(0, len(array), chunk_rows):
+        digest.update(np.ascontiguousarray(array[start:start+chunk_rows]).data)
+    return digest.hexdigest()
+
+def pca_fit_key(data_fingerprint,labels,weights,n_components,solver,dtype = None):
+    """
+    Key of a fit in the PCA cache: the fingerprints of the data, labels and weights, and the settings of the fit
+    """
+    return (data_fingerprint, array_fingerprint(labels), array_fingerprint(weights), n_components, solver, float_dtype(dtype).str)
+
+def get_pca_fit(data,labels,n_components,weights = None,solver = 'full',use_cache = True,dtype = None):
+    """
+    Fit the PCA of the normal data (see pca_all_processes()), or reuse the cached fit of the same data, labels and settings
+    Returns the PCAFit and the fingerprint of the data (to reuse with pca_fit_cache.encode()); the data is only hashed
+    if use_cache is on, otherwise the fingerprint is None
+    """
+    data_fingerprint = key = None
+    if use_cache:
+        data_fingerprint = array_fingerprint(data)
+        key = pca_fit_key(data_fingerprint,labels,weights,n_components,solver,dtype)
+    fit = pca_fit_cache.get(key) if use_cache else None
+    if fit is None:
+        normal_weights = None if weights is None else weights[labels == 0]
+        pca_matrix, component_mean, eigen_value = compute_pca_matrix(data[labels == 0],normal_weights,n_components,solver,return_eigen_value=True,dtype=dtype)
+        fit = PCAFit(pca_matrix,component_mean,n_components,eigen_value)
+        if use_cache:
+            pca_fit_cache.put(key,fit)
+    return fit, data_fingerprint
+
+
+## Support Functions for Saved PCA Models
+# Version of the layout of the saved PCA models; models saved with a newer version are not read
+# - 1: first layout
+# - 2: the threshold of the PCA Gaussian models is on the log-density instead of the probability
+pca_model_version = 2
+
+class PCAModel:
+    """
+    Class for a fitted PCA detector that is saved next to the autoencoder model, so it can score new data without refitting
+    Parameters:
+    - pca_matrix: the sorted eigenvectors, see compute_pca_matrix()
+    - component_mean: the mean of the normal training data
+    - eigen_value: the variance along each column of the PCA Matrix
+    - n_components: number of components used for encoding
+    - gaussian_mean, gaussian_cov: the multivariate gaussian of the encoded data (PCA Gaussian only)
+    - gaussian: the GaussianModel of gaussian_mean and gaussian_cov, factored once for all the chunks (None if no gaussian)
+    - threshold: the threshold selected on the training set (None if it was not recorded)
+    - detect_model: the name of the anomaly detection model
+    """
+
+    def __init__(self,pca_matrix,component_mean,eigen_value,n_components,gaussian_mean=None,gaussian_cov=None,threshold=None,detect_model=''):
+        self.pca_matrix = pca_matrix # Matrix n*n (or n*k)
+        self.component_mean = component_mean # Vector of length n
+        self.eigen_value = eigen_value # Vector of length n (or k)
+        self.n_components = n_components # Integer
+        self.gaussian_mean = gaussian_mean # Vector of length n_components or None
+        self.gaussian_cov = gaussian_cov # Matrix n_components*n_components or None
+        self.gaussian = None if gaussian_mean is None else GaussianModel(gaussian_mean, gaussian_cov) # GaussianModel or None
+        self.threshold = threshold # Double or None
+        self.detect_model = detect_model # String
+
+    def reconstruction_error(self,data):
+        return pca_reconstruction_error(data,self.component_mean,self.pca_matrix,self.n_components)
+
+    def log_density(self,data):
+        return self.gaussian.logpdf(encode_pca(data,self.component_mean,self.pca_matrix,self.n_components))
+
+    def score(self,data,chunk_size = None):
+        """
+        The log-density of being normal if the model has a gaussian, the reconstruction error otherwise
+        """
+        if self.gaussian_mean is not None:
+            return score_in_chunks(self.log_density,data,chunk_size)
+        return score_in_chunks(self.reconstruction_error,data,chunk_size)
+
+    def predict(self,data,chunk_size = None):
+        """
+        Predict 1 for anomaly and 0 for normal with the saved threshold, as in train_test_with_distance() and train_test_with_probability()
+        """
+        if self.threshold is None:
+            raise ValueError('The saved model has no threshold: it was fitted with to_print = True')
+        scores = self.score(data,chunk_size)
+        if self.gaussian_mean is not None:
+            return (scores < self.threshold).astype(int) # Low log-density: anomaly
+        return (scores > self.threshold).astype(int) # High reconstruction error: anomaly
+
+def pca_model_path(AnomalyData,detect_model):
+    """
+    Folder of the saved model of a PCA detector, next to the autoencoder model
+    """
+    model = detect_model.lower().replace(' ','_')
+    return AnomalyData.folder_path + 'model_' + model + '/'
+
+def component_variance(cov_matrix,pca_matrix):
+    """
+    Variance along each column of the PCA Matrix (the eigenvalues, if the columns are eigenvectors of cov_matrix)
+    """
+    return np.einsum('ij,ij->j', pca_matrix, cov_matrix.dot(pca_matrix))
+
+def save_pca_model(model_path,model):
+    """
+    Save a PCAModel as a dataset store (see data_store.py): one raw file per array (in its float type), described by the JSON header.
+    The settings are recorded under 'model' in the header, written last, so a partly written model is never read.
+    """
+    os.makedirs(model_path, exist_ok=True)
+    write_store_header(model_path, {'arrays': {}, 'label_index': {}}) # Drop the arrays of an earlier model
+    arrays = {'pca_matrix': model.pca_matrix, 'component_mean': model.component_mean, 'eigen_value': model.eigen_value}
+    if model.gaussian_mean is not None:
+        arrays['gaussian_mean'] = model.gaussian_mean
+        arrays['gaussian_cov'] = model.gaussian_cov
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        save_store_array(model_path, name, array, dtype = array.dtype)
+    header = read_store_header(model_path)
+    header['model'] = {
+        'version': pca_model_version,
+        'detect_model': model.detect_model,
+        'n_components': int(model.n_components),
+        'threshold': None if model.threshold is None else float(model.threshold),
+    }
+    write_store_header(model_path, header)
+
+def load_pca_model(model_path):
+    """
+    Load a PCAModel saved by save_pca_model(); the arrays are memory-mapped, so nothing is refitted or read ahead
+    """
+    store = open_dataset_store(model_path)
+    settings = store.header.get('model')
+    if settings is None:
+        raise ValueError('No saved PCA model in ' + model_path)
+    if settings['version'] > pca_model_version:
+        raise ValueError('The PCA model in ' + model_path + ' was saved with a newer version: ' + str(settings['version']))
+    if settings['version'] < 2 and 'gaussian_mean' in store:
+        raise ValueError('The PCA model in ' + model_path + ' has a threshold on the probability (version 1): refit it to score with the log-density')
+    gaussian_mean = store['gaussian_mean'] if 'gaussian_mean' in store else None
+    gaussian_cov = store['gaussian_cov'] if 'gaussian_cov' in store else None
+    return PCAModel(store['pca_matrix'],store['component_mean'],store['eigen_value'],settings['n_components'],gaussian_mean,gaussian_cov,settings['threshold'],settings['detect_model'])
+
+
+## Support Functions for Streaming PCA
+class CovarianceAccumulator:
+    """
+    Class to accumulate the mean and covariance of data that arrives chunk by chunk.
+    Every chunk is centered on its own mean, and the partial statistics are merged with the pairwise
+    formula of Chan et al., which stays accurate when the mean is large compared to the variance.
+    Parameters:
+    - n_features: number of dimensions
+    - n: number of rows seen so far (sum of the weights)
+    - mean: mean of the rows seen so far
+    - m2: sum of the outer products of the centered rows (n_features*n_features)
+    """
+
+    def __init__(self,n_features):
+        self.n_features = n_features # Integer
+        self.n = 0 # Double
+        self.mean = np.zeros(n_features) # Vector of length n_features
+        self.m2 = np.zeros((n_features,n_features)) # Matrix n_features*n_features
+
+    def add_chunk(self,chunk,weights=None):
+        """
+        Add the rows of a chunk (m*n_features), with optional integer multiplicities
+        """
+        chunk = np.asarray(chunk, dtype = np.float64)
+        if len(chunk) == 0:
+            return self
+        chunk_stats = CovarianceAccumulator(self.n_features)
+        chunk_stats.n = len(chunk) if weights is None else float(np.sum(weights))
+        chunk_stats.mean = np.average(chunk, axis = 0, weights = weights)
+        chunk_shifted = chunk - chunk_stats.mean
+        chunk_weighted = chunk_shifted if weights is None else chunk_shifted * np.asarray(weights)[:,None]
+        chunk_stats.m2 = chunk_weighted.T.dot(chunk_shifted)
+        return self.merge(chunk_stats)
+
+    def merge(self,other):
+        """
+        Merge the statistics of another accumulator (e.g. computed by another worker) into this one
+        """
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.m2 = self.m2 + other.m2 + np.outer(delta, delta) * (self.n * other.n / n)
+        self.mean = self.mean + delta * (other.n / n)
+        self.n = n
+        return self
+
+    def covariance(self):
+        """
+        Sample covariance of the rows seen so far (same normalization as np.cov)
+        """
+        return self.m2 / (self.n - 1)
+
+def iter_chunks(data,chunk_size,labels = None):
+    """
+    Yield the rows of the data (e.g. a memory map) chunk by chunk; only the normal rows (labels == 0) if labels are given
+    """
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start+chunk_size]
+        if labels is not None:
+            chunk = chunk[np.asarray(labels[start:start+chunk_size]) == 0]
+        yield chunk
+
+def accumulate_covariance(chunks,n_features,accumulator = None):
+    """
+    Accumulate the statistics of an iterable of chunks (e.g. iter_chunks() or a generator of new data)
+    accumulator: an existing accumulator to add the chunks to; a new one is created if None
+    """
+    if accumulator is None:
+        accumulator = CovarianceAccumulator(n_features)
+    for chunk in chunks:
+        accumulator.add_chunk(chunk)
+    return accumulator
+
+def accumulate_covariance_parallel(data,labels = None,chunk_size = 2**14,n_workers = 1):
+    """
+    Accumulate the statistics of the data with n_workers threads: each thread reads a contiguous block of chunks
+    (numpy releases the GIL in the matrix products), and the partial statistics are merged at the end
+    """
+    n_features = data.shape[1]
+    starts = list(range(0, len(data), chunk_size))
+    blocks = [list(block) for block in np.array_split(starts, n_workers)]
+    def accumulate_block(block_starts):
+        accumulator = CovarianceAccumulator(n_features)
+        for start in block_starts:
+            end = start + chunk_size
+            chunk_labels = None if labels is None else labels[start:end]
+            accumulate_covariance(iter_chunks(data[start:end],chunk_size,chunk_labels),n_features,accumulator)
+        return accumulator
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            partials = list(executor.map(accumulate_block, blocks))
+    else:
+        partials = [accumulate_block(starts)]
+    accumulator = CovarianceAccumulator(n_features)
+    for partial in partials:
+        accumulator.merge(partial)
+    return accumulator
+
+def pca_from_accumulator(accumulator,n_components = None,solver = 'full',return_eigen_value = False,dtype = None):
+    """
+    PCA Matrix and mean of the data summarized by an accumulator, as returned by compute_pca_matrix()
+    The statistics are accumulated in float64; the eigendecomposition runs in dtype (see compute_dtype)
+    """
+    dtype = float_dtype(dtype)
+    eigen_value, pca_matrix = sorted_eigenvectors(accumulator.covariance().astype(dtype),n_components,solver)
+    component_mean = accumulator.mean.astype(dtype)
+    if return_eigen_value:
+        return pca_matrix, component_mean, eigen_value
+    return pca_matrix, component_mean
+
+def fit_pca_streaming(data,labels = None,chunk_size = 2**14,n_components = None,solver = 'full',n_workers = 1,accumulator = None,dtype = None):
+    """
+    Fit the PCA of the normal rows without loading the data into memory: the data (e.g. a memory map) is read
+    chunk by chunk, and the memory use is bounded by chunk_size*n plus the n*n covariance.
+    accumulator: the accumulator of an existing fit, to add new normal data to it
+    Returns the PCA Matrix, the mean, and the accumulator (to update the fit later)
+    """
+    partial = accumulate_covariance_parallel(data,labels,chunk_size,n_workers)
+    if accumulator is not None:
+        partial = accumulator.merge(partial)
+    pca_matrix, component_mean = pca_from_accumulator(partial,n_components,solver,dtype = dtype)
+    return pca_matrix, component_mean, partial
+
+def fit_gaussian_streaming(data,transform,chunk_size = 2**14):
+    """
+    Fit the multivariate gaussian of transform(data) (e.g. the PCA encoding) chunk by chunk
+    """
+    chunks = (transform(chunk) for chunk in iter_chunks(data,chunk_size))
+    first_chunk = next(chunks)
+    accumulator = accumulate_covariance(chunks,first_chunk.shape[1],CovarianceAccumulator(first_chunk.shape[1]).add_chunk(first_chunk))
+    return GaussianModel(accumulator.mean, accumulator.covariance())
+
+def score_in_chunks(score_func,data,chunk_size = None):
+    """
+    Apply score_func to the data chunk by chunk, so only one chunk of the transformed data is in memory
+    """
+    if chunk_size is None:
+        return score_func(data)
+    scores = np.empty(len(data))
+    for start in range(0, len(data), chunk_size):
+        scores[start:start+chunk_size] = score_func(data[start:start+chunk_size])
+    return scores
+
+
+
+## Support Functions for the Online Gaussian
+class OnlineGaussianModel(CholeskyGaussian):
+    """
+    Class for a multivariate gaussian that is updated with new batches of normal rows (e.g. new normal data encoded with
+    the PCA or the autoencoder), without refitting on the rows seen before.
+    A batch of m rows is a rank-(m+1) update of the scatter matrix: its centered rows plus the shift of the mean.
+    The Cholesky factor L of the covariance is updated with the same rank-(m+1) term, from the QR of L^T stacked on
+    the update, so a batch costs O(m k^2 + k^3) in k dimensions, whatever the number of rows seen before.
+    The rows are scored with the log-density, as in GaussianModel, but with a triangular solve (see CholeskyGaussian):
+    the factor changes with every batch, so it is not inverted.
+    Parameters:
+    - statistics: the CovarianceAccumulator of the rows seen so far (the counts are weighted by the forgetting)
+    - forgetting: weight in (0,1] of the statistics seen so far when a batch is added; 1 keeps every row, a smaller value
+      follows a drift of the normal data, with a memory of about 1/(1-forgetting) batches
+    - refresh_every: None to update the factor with every batch; an integer n to keep the factor and refactor the
+      covariance after every n batches (the rows are scored with the factor of the last refresh in between)
+    - mean, cov_cholesky, log_det: the factorization that scores the rows; whitening is None
+    - n_batches: number of batches added since the last refresh
+    """
+
+    def __init__(self,statistics,forgetting = 1.0,refresh_every = None):
+        if not 0 < forgetting <= 1:
+            raise ValueError('The forgetting factor must be in (0,1]: ' + str(forgetting))
+        self.statistics = statistics # CovarianceAccumulator
+        self.forgetting = forgetting # Double
+        self.refresh_every = refresh_every # int or None
+        self.n_batches = 0 # Integer
+        self.whitening = None # Score with a triangular solve
+        self.refresh()
+
+    def refresh(self):
+        """
+        Factor the covariance of the current statistics again (also removes the rounding of the incremental updates)
+        """
+        self.mean = self.statistics.mean.copy() # Vector of length k
+        self.cov_cholesky = np.linalg.cholesky(self.statistics.covariance()) # Raises LinAlgError if the covariance is singular
+        self.log_det = 2 * np.sum(np.log(np.diag(self.cov_cholesky))) # Double
+        self.n_batches = 0
+        return self
+
+    def add_batch(self,batch):
+        """
+        Add a batch of normal rows (m*k): forget the statistics seen so far, merge the batch, then update or refresh the factor
+        """
+        batch = np.asarray(batch, dtype = np.float64).reshape(-1, self.statistics.n_features)
+        if len(batch) == 0:
+            return self
+        acc = self.statistics
+        n_before = acc.n
+        acc.n = acc.n * self.forgetting
+        acc.m2 = acc.m2 * self.forgetting
+        mean_before = acc.mean
+        batch_stats = CovarianceAccumulator(acc.n_features).add_chunk(batch)
+        # The update of the scatter matrix: m2_new = forgetting*m2 + U^T U
+        update = np.vstack([batch - batch_stats.mean, np.sqrt(acc.n * batch_stats.n / (acc.n + batch_stats.n)) * (batch_stats.mean - mean_before)])
+        acc.merge(batch_stats)
+        self.n_batches += 1
+
+        if self.refresh_every is None:
+            # cov_new = (forgetting*(n-1)*L L^T + U^T U) / (n_new-1) = R^T R, with R from the QR of the stacked factors
+            factors = np.vstack([np.sqrt(self.forgetting * (n_before - 1) / (acc.n - 1)) * self.cov_cholesky.T, update / np.sqrt(acc.n - 1)])
+            r = np.linalg.qr(factors, mode = 'r')
+            self.cov_cholesky = (r * np.sign(np.diag(r))[:,None]).T # Positive diagonal
+            self.mean = acc.mean.copy()
+            self.log_det = 2 * np.sum(np.log(np.diag(self.cov_cholesky)))
+        elif self.n_batches >= self.refresh_every:
+            self.refresh()
+        return self
+
+    def gaussian_model(self):
+        """
+        The GaussianModel of the current statistics (e.g. to save it with a PCAModel)
+        """
+        return GaussianModel(self.statistics.mean, self.statistics.covariance())
+
+def gaussian_statistics(mean,cov,n_rows):
+    """
+    The CovarianceAccumulator of n_rows rows with the given mean and covariance, e.g. to start an OnlineGaussianModel
+    from a fitted GaussianModel (whitened or shrunk) that counts as n_rows rows
+    """
+    statistics = CovarianceAccumulator(len(mean))
+    statistics.n = float(n_rows)
+    statistics.mean = np.asarray(mean, dtype = np.float64).copy()
+    statistics.m2 = np.asarray(cov, dtype = np.float64) * (n_rows - 1)
+    return statistics
+
+def fit_online_gaussian(data,transform = None,chunk_size = 2**14,forgetting = 1.0,refresh_every = None):
+    """
+    Fit an OnlineGaussianModel to transform(data) (e.g. the PCA or autoencoder encoding) chunk by chunk
+    """
+    chunks = iter_chunks(data,chunk_size)
+    if transform is not None:
+        chunks = (transform(chunk) for chunk in chunks)
+    first_chunk = next(chunks)
+    statistics = accumulate_covariance(chunks,first_chunk.shape[1],CovarianceAccumulator(first_chunk.shape[1]).add_chunk(first_chunk))
+    return OnlineGaussianModel(statistics,forgetting,refresh_every)
+
+def update_online_gaussian(model,data,transform = None,chunk_size = 2**14):
+    """
+    Add new normal rows to an OnlineGaussianModel: transform(data) is added chunk by chunk, one batch per chunk
+    (so the forgetting applies once per chunk)
+    """
+    for chunk in iter_chunks(data,chunk_size):
+        model.add_batch(chunk if transform is None else transform(chunk))
+    return model
+
+## Support Functions for Per-Class Statistics
+def class_statistics(data,classes,chunk_size = 2**14):
+    """
+    Accumulate the count, mean and scatter matrix of every class in one pass over the data, chunk by chunk
+    - classes: the class of every row (e.g. the MNIST digits)
+    Returns a dictionary of class -> CovarianceAccumulator
+    """
+    n_features = data.shape[1]
+    class_stats = {}
+    for start in range(0, len(data), chunk_size):
+        chunk = np.asarray(data[start:start+chunk_size], dtype = np.float64)
+        chunk_classes = np.asarray(classes[start:start+chunk_size])
+        for c in np.unique(chunk_classes):
+            if c.item() not in class_stats:
+                class_stats[c.item()] = CovarianceAccumulator(n_features)
+            class_stats[c.item()].add_chunk(chunk[chunk_classes == c])
+    return class_stats
+
+def combine_class_statistics(class_stats,exclude = ()):
+    """
+    Merge the statistics of all the classes except the ones in exclude into a new accumulator
+    """
+    n_features = next(iter(class_stats.values())).n_features
+    accumulator = CovarianceAccumulator(n_features)
+    for c, class_stat in class_stats.items():
+        if c not in exclude:
+            accumulator.merge(class_stat)
+    return accumulator
+
+def leave_one_class_out_pca(class_stats,anomaly_class,n_components = None,solver = 'full',dtype = None):
+    """
+    PCA Matrix, mean and eigenvalues of the normal data when anomaly_class is the anomaly (all the other classes are normal)
+    """
+    return pca_from_accumulator(combine_class_statistics(class_stats,exclude = (anomaly_class,)),n_components,solver,return_eigen_value = True,dtype = dtype)
+
+def leave_one_class_out_gaussian(class_stats,pca_matrix,component_mean,n_components):
+    """
+    The multivariate gaussian of the PCA Gaussian detector for the PCA of leave_one_class_out_pca(), without encoding the data:
+    the gaussian is fitted to all the training rows encoded with the PCA of the normal rows, so with the mean m and
+    covariance C of all the rows, its mean is P_k^T (m - mu) and its covariance is P_k^T C P_k
+    """
+    pca_matrix_k = pca_matrix[:,:n_components].astype(np.float64)
+    accumulator = combine_class_statistics(class_stats)
+    mu = pca_matrix_k.T.dot(accumulator.mean - component_mean.astype(np.float64))
+    cov = pca_matrix_k.T.dot(accumulator.covariance()).dot(pca_matrix_k)
+    return GaussianModel(mu, cov)
+
+
+## Support Functions for Parallel Cross Validation
+cv_lam_block_size = 4 # Number of lambdas per task of the whitening cross validation (fixed, so the tasks do not depend on n_workers)
+cv_shared_arrays = {} # The arrays of the running cross validation: name -> array (a view on shared memory in the workers)
+cv_shared_blocks = [] # The shared memory blocks attached by a worker, kept open while it runs
+cv_seed = 0 # Seed of the fold assignment, so the folds (and the selected hyperparameters) are reproducible
+
+def cv_fold_ids(labels,folds,seed = cv_seed):
+    """
+    Fold of every row, with the shuffled folds of sklearn's StratifiedKFold: the rows of a split are kept in file order
+    (e.g. the Yale Faces subjects folder by folder), so contiguous folds would split by subject, and some folds would
+    hold no anomaly; every fold gets its share of the anomalies instead
+    """
+    labels = np.asarray(labels)
+    fold_of_row = np.empty(len(labels), dtype = int)
+    kf = StratifiedKFold(n_splits = folds, shuffle = True, random_state = seed)
+    for fold, (train_index, test_index) in enumerate(kf.split(np.zeros((len(labels),1)),labels)):
+        fold_of_row[test_index] = fold
+    return fold_of_row
+
+def attach_shared_arrays(specs):
+    """
+    Worker initializer of run_cv_tasks(): map the shared memory blocks as numpy arrays, without copying them
+    """
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name = block_name)
+        cv_shared_blocks.append(block)
+        cv_shared_arrays[name] = np.ndarray(shape, dtype = np.dtype(dtype), buffer = block.buf)
+
+def run_cv_tasks(task_func,tasks,arrays,n_workers = 1):
+    """
+    Run the cross-validation tasks (e.g. fold * hyperparameter) on a pool of n_workers processes
+    - task_func: a module-level function of one task; it reads the arrays from cv_shared_arrays
+    - arrays: a dictionary of name -> array; each array is copied once into a shared memory block that every worker maps,
+      so the tasks only pickle their own small arguments
+    The results are returned in the order of the tasks, and each task only depends on its arguments,
+    so the results do not depend on n_workers.
+    The workers are spawned, not forked: forking a process that has TensorFlow loaded is unsafe. Each worker imports
+    this module (and TensorFlow) when it starts, so a pool only pays off for tasks that take seconds.
+    """
+    if n_workers <= 1:
+        cv_shared_arrays.update(arrays)
+        try:
+            return [task_func(task) for task in tasks]
+        finally:
+            cv_shared_arrays.clear()
+
+    blocks = []
+    specs = {}
+    try:
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create = True, size = max(array.nbytes,1))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)[...] = array
+            specs[name] = (block.name, array.shape, array.dtype.str)
+        with get_context('spawn').Pool(min(n_workers,len(tasks)), initializer = attach_shared_arrays, initargs = (specs,)) as pool:
+            return pool.map(task_func, tasks)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+def threshold_cv_task(task):
+    """
+    Cross-validation task of select_threshold_cv(): select the threshold on the training folds, and score it on the held-out fold
+    Returns the threshold and its F score on the held-out fold
+    """
+    fold, anomaly_at_top, k = task
+    val, labels, fold_of_row = cv_shared_arrays['val'], cv_shared_arrays['labels'], cv_shared_arrays['fold_of_row']
+    ind_train = fold_of_row != fold
+    ind_test = fold_of_row == fold
+    threshold = select_threshold(val[ind_train],labels[ind_train],anomaly_at_top,k)
+    f_test = threshold_f_scores(val[ind_test],labels[ind_test],np.array([threshold]),anomaly_at_top)[0]
+    return threshold, f_test
+
 ## Support Function for the deep autoencoder
 def train_autoencoder(AnomalyData, data, labels,epochs_size = 80, batch_size = 256,dropout =0,save_model = True):
     """
     AnomalyData: an instance of the class Anomaly Data
     data is a matrix of size m*n, where m is the sample size, and n is the dimenions
     labels is a vector of length n
+    If AnomalyData.dedup is True, the model is trained on the unique normal rows with their counts as sample weights
     """
     # Specify the model config
-    data_dimensions=data_train.shape[1] # No.dimensions in the data
+    data_dimensions=data.shape[1] # No.dimensions in the data
     encoder_hidden_layers = AnomalyData.encoder_hidden_layers
     decoder_hidden_layers = AnomalyData.decoder_hidden_layers
     # Extract the saved autoencoder model
@@ -1388,28 +2952,56 @@ def train_autoencoder(AnomalyData, data, labels,epochs_size = 80, batch_size = 2
     # Select only the Normal Image Dataset
     data_normal = data[labels == 0]
 
-    # Split the images and labels
-    # By default: 80% in training and 20% in testing
-    train_ind, test_ind = perm_and_split(len(data_normal))
-    x_train = data_normal[train_ind,:]
-    x_test = data_normal[test_ind,:]
+    if AnomalyData.dedup:
+        # Collapse the duplicated rows; the count of each pattern is split 80/20 between training and validation
+        unique_normal = find_unique_rows(data_normal)
+        counts_train = np.random.binomial(unique_normal.counts, 0.8)
+        counts_test = unique_normal.counts - counts_train
+        x_train = unique_normal.patterns[counts_train > 0]
+        x_test = unique_normal.patterns[counts_test > 0]
+        weights_train = counts_train[counts_train > 0]
+        weights_test = counts_test[counts_test > 0]
+    else:
+        # Split the images and labels
+        # By default: 80% in training and 20% in testing
+        train_ind, test_ind = perm_and_split(len(data_normal))
+        x_train = data_normal[train_ind,:]
+        x_test = data_normal[test_ind,:]
+        weights_train = weights_test = None
 
     # Normalize the Data
     if AnomalyData.is_image_data:
         x_train = x_train.astype('float32') / 255.
         x_test = x_test.astype('float32') / 255.
     # Run the model
+    if weights_test is None:
+        validation_data = (x_test, x_test)
+    else:
+        validation_data = (x_test, x_test, weights_test)
     autoencoder.fit(x_train, x_train,
                     epochs = epochs_size,
                     batch_size = batch_size,
                     shuffle=True,
-                    validation_data=(x_test, x_test)) # x_train images are both the target and input
+                    sample_weight=weights_train,
+                    validation_data=validation_data) # x_train images are both the target and input
 
     # Save and output the model
     if save_model:
         autoencoder.save(AnomalyData.model_path)
     return autoencoder,encoder
 
+def load_encoder(AnomalyData):
+    """
+    Load the saved autoencoder model of the dataset, and extract its encoder
+    The encoder shares the layers of the loaded model (the input layer, then len(encoder_hidden_layers) dense layers),
+    so it uses the saved layer sizes and weights as they are
+    Returns the autoencoder and the encoder
+    """
+    autoencoder = load_model(AnomalyData.model_path, compile = False) # Load the saved model; only used to encode and decode
+    encoder_n_layers = len(AnomalyData.encoder_hidden_layers) # Get the number of layers in the encoder
+    encoder = Model(autoencoder.input, autoencoder.layers[encoder_n_layers].output) # The first half of the autoencoder model is an encoder model
+    return autoencoder, encoder
+
 def compile_autoencoder(data_length, encoder_hidden_layers,decoder_hidden_layers,dropout = 0):
     '''
     Function to construct and compile the deep autoencoder, then return the model
@@ -1561,7 +3153,7 @@ def encode_and_viz_corr_pca(AnomalyData, data,labels):
     This function encode the data and vizualize the correlation after encoding via PCA
     """    
     # Compute PCA with the dataset
-    data_encoded,n,m = pca_all_processes(data,labels,AnomalyData.n_components,decode = False)
+    data_encoded,n,m = pca_all_processes(data,labels,AnomalyData.n_components,decode = False,solver = AnomalyData.pca_solver,dtype = AnomalyData.dtype)
     # Visualize the correlation in the encoded data 
     
     viz_corr_after_encoding(data_encoded, labels)
@@ -0,0 +1,146 @@
+import numpy as np
+import time
+from multiprocessing import Pool, cpu_count
+from data_store import * # Memory-mapped dataset store and bit packing
+
+# Labeling rules of the synthetic datasets
+# - 'row_sum': anomaly if the total number of 1s in the row is less than the threshold (Synthetic, Synthetic_4)
+# - 'parity': anomaly if the number of 1s in the right n-1 digits is even and the leftmost digit is 1 (Synthetic_2)
+# - 'mixture': anomaly if the row is generated by a component outside normal_components (Synthetic_3)
+label_rules = ['row_sum','parity','mixture']
+
+def generate_gaussian_components(rng,n_dimensions,n_components):
+    """
+    Draw the parameters of each multivariate gaussian component, as in the original generate_data.py scripts:
+    a random mean vector and a random (not necessarily positive semi-definite) covariance matrix.
+    The covariance is factorized once with the SVD, the same way np.random.multivariate_normal does it,
+    so the chunks only need a matrix product: x = z * factor + mu
+    """
+    components = []
+    for c in range(n_components):
+        mu = rng.random(n_dimensions) # Random vector for mean
+        cov = rng.random((n_dimensions,n_dimensions)) # Random matrix for covaraince
+        u, s, v = np.linalg.svd(cov)
+        factor = np.sqrt(s)[:,None] * v
+        components.append((mu, factor))
+    return components
+
+def label_binary_rows(bits,component,label_rule,anomaly_threshold = 4,normal_components = (0,)):
+    """
+    Apply one of the labeling rules to binary rows (m*n); returns a boolean vector where True is anomaly
+    component: the index of the gaussian component that generated each row (used by the 'mixture' rule)
+    """
+    if label_rule == 'row_sum':
+        return np.sum(bits,axis = 1) < anomaly_threshold
+    if label_rule == 'parity':
+        data_right_rowsum = np.sum(bits[:,1:],axis = 1)
+        return (data_right_rowsum % 2 == 0) & (bits[:,0] == 1)
+    if label_rule == 'mixture':
+        return ~np.isin(component, normal_components)
+    raise ValueError('Unknown labeling rule: ' + str(label_rule))
+
+def generate_binary_chunk(seed_seq,n_rows,components,weights,label_rule,anomaly_threshold,normal_components,remove_anomaly_ratio):
+    """
+    Generate one chunk of binary rows with its own random stream.
+    Returns the bit-packed rows and labels that are kept after removing a share of the anomalies.
+    """
+    rng = np.random.default_rng(seed_seq)
+    n_dimensions = len(components[0][0])
+    component = rng.choice(len(components), size = n_rows, p = weights) # Mixture membership of each row
+    data_mg = np.empty((n_rows,n_dimensions))
+    for c, (mu, factor) in enumerate(components):
+        rows = component == c
+        data_mg[rows] = rng.standard_normal((int(np.sum(rows)),n_dimensions)).dot(factor) + mu
+    bits = data_mg >= 0.5 # Convert to binary - True if the data is larger than 0.5; otherwise 0
+    labels = label_binary_rows(bits,component,label_rule,anomaly_threshold,normal_components)
+
+    # Remove a share of the anomalies when there are too many of them
+    keep = ~(labels & (rng.random(n_rows) < remove_anomaly_ratio))
+    return pack_binary_rows(bits[keep]), labels[keep]
+
+def generate_binary_chunk_to_store(task):
+    """
+    Worker task: generate one chunk and write it into the store at the given start row.
+    Returns the number of rows kept, so the main process can close the gaps between chunks.
+    """
+    store_path, start, seed_seq, n_rows, params = task
+    packed, labels = generate_binary_chunk(seed_seq, n_rows, **params)
+    data_out = open_store_array(store_path, 'data_packed')
+    labels_out = open_store_array(store_path, 'labels')
+    data_out[start:start+len(packed)] = packed
+    labels_out[start:start+len(labels)] = labels
+    data_out.flush()
+    labels_out.flush()
+    return len(packed)
+
+def generate_synthetic_store(store_path,n_samples,n_dimensions = 16,n_components = 1,component_weights = None,label_rule = 'row_sum',anomaly_threshold = 4,normal_components = (0,),max_anomaly_ratio = 0.2,remove_anomaly_ratio = 0.6,seed = 9001,chunk_size = 10**6,n_workers = cpu_count()):
+    """
+    Generate a binary synthetic dataset chunk by chunk and save it bit-packed in a dataset store.
+    - n_samples: number of rows to generate (before removing anomalies); can be far larger than the RAM
+    - n_components, component_weights: the gaussian mixture that generates the rows (equal weights by default)
+    - label_rule, anomaly_threshold, normal_components: see label_binary_rows()
+    - max_anomaly_ratio, remove_anomaly_ratio: if the share of anomalies (estimated on the first chunk) is above
+      max_anomaly_ratio, each anomaly is removed with the probability remove_anomaly_ratio
+    - seed: one seed for the whole dataset; every chunk gets an independent stream spawned from it,
+      so the result does not depend on n_workers
+    - chunk_size: number of rows generated per task
+    """
+    seed_seq = np.random.SeedSequence(seed)
+    param_seq, chunks_seq = seed_seq.spawn(2)
+    components = generate_gaussian_components(np.random.default_rng(param_seq),n_dimensions,n_components)
+    if component_weights is None:
+        component_weights = np.ones(n_components)/n_components
+    params = {'components': components, 'weights': np.asarray(component_weights), 'label_rule': label_rule, 'anomaly_threshold': anomaly_threshold, 'normal_components': normal_components, 'remove_anomaly_ratio': 0}
+
+    starts = list(range(0,n_samples,chunk_size))
+    chunk_seqs = chunks_seq.spawn(len(starts))
+
+    # Estimate the share of anomalies with the first chunk to decide if anomalies should be removed
+    packed, labels = generate_binary_chunk(chunk_seqs[0], min(chunk_size,n_samples), **params)
+    anomaly_ratio = np.sum(labels)/len(labels)
+    print("Percentage of Anomaly in the dataset: " + str(anomaly_ratio))
+    if anomaly_ratio > max_anomaly_ratio:
+        print("Too much anomaly: start cleaning!")
+        params['remove_anomaly_ratio'] = remove_anomaly_ratio
+
+    # Preallocate the store for all the rows; the unused tail is cut off at the end
+    create_store_array(store_path, 'data_packed', (n_samples,), packed_dtype(n_dimensions), attributes = {'n_dimensions': n_dimensions, 'packing': 'bits, first dimension is the most significant bit'})
+    create_store_array(store_path, 'labels', (n_samples,), np.bool_)
+
+    tasks = [(store_path, start, chunk_seqs[i], min(chunk_size,n_samples-start), params) for i, start in enumerate(starts)]
+    time_start = time.time()
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            n_kept = pool.map(generate_binary_chunk_to_store, tasks)
+    else:
+        n_kept = [generate_binary_chunk_to_store(task) for task in tasks]
+    print("Generated {0} rows in {1:.1f}s".format(n_samples, time.time() - time_start))
+
+    # Close the gaps left by the removed anomalies: chunks only move towards the beginning of the file
+    data_packed = open_store_array(store_path, 'data_packed')
+    labels_all = open_store_array(store_path, 'labels')
+    end = 0
+    for start, n in zip(starts, n_kept):
+        if start != end:
+            data_packed[end:end+n] = data_packed[start:start+n]
+            labels_all[end:end+n] = labels_all[start:start+n]
+        end += n
+    data_packed.flush()
+    labels_all.flush()
+    del data_packed, labels_all
+    resize_store_array(store_path, 'data_packed', end)
+    resize_store_array(store_path, 'labels', end)
+    set_store_labels(store_path, 'data_packed', 'labels')
+
+    store = open_dataset_store(store_path)
+    print("Percentage of Anomaly in the dataset after cleaning: " + str(np.sum(store['labels'])/len(store['labels'])))
+    return store
+
+def read_binary_rows(store,ind = None):
+    """
+    Read (a subset of) the binary rows of a store built by generate_synthetic_store() as a uint8 matrix
+    ind: the indices of the rows to read; all the rows are read if it is None
+    """
+    n_dimensions = store.attributes('data_packed')['n_dimensions']
+    packed = store['data_packed'] if ind is None else store['data_packed'][ind]
+    return unpack_binary_rows(packed, n_dimensions)